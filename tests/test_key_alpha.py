@@ -0,0 +1,18 @@
+import importlib.util
+import os
+
+import numpy as np
+from PIL import Image
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "快速拼合序列图_v3.py")
+spec = importlib.util.spec_from_file_location("atlas_tool", SCRIPT)
+atlas_tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(atlas_tool)
+
+
+def test_luminance_alpha_matches_bt601():
+    pixels = np.array([[[255, 255, 255, 255], [128, 128, 128, 255], [0, 0, 0, 255], [255, 128, 0, 255],
+                        [255, 255, 255, 128]]], dtype=np.uint8)
+    keyed = np.asarray(atlas_tool.key_alpha(Image.fromarray(pixels), key_color=None, luminance=True))
+    assert keyed[0, :, 3].tolist() == [255, 128, 0, 152, 128]
+    assert np.array_equal(keyed[..., :3], pixels[..., :3])
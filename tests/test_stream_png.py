@@ -0,0 +1,42 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "快速拼合序列图_v3.py")
+spec = importlib.util.spec_from_file_location("atlas_tool", SCRIPT)
+atlas_tool = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(atlas_tool)
+
+
+def make_atlas(height=768, width=1024):
+    rng = np.random.default_rng(0)
+    atlas = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    atlas[: height // 2, :, :3] //= 32  # 一半区域容易压缩，块大小不均匀
+    return atlas
+
+
+@pytest.mark.parametrize("profile", ["balanced", "fast", {"compress_level": 6, "png_filter": "adaptive", "threads": 4}])
+def test_png_bytes_do_not_depend_on_band_height(tmp_path, profile):
+    atlas = make_atlas()
+    size = (atlas.shape[1], atlas.shape[0])
+    outputs = []
+    for band_rows in (7, 64, 256, atlas.shape[0]):
+        path = tmp_path / f"atlas_{band_rows}.png"
+        atlas_tool.write_atlas(str(path), atlas_tool.array_bands(atlas, band_rows), size, "png", profile)
+        outputs.append(path.read_bytes())
+    assert all(data == outputs[0] for data in outputs[1:])
+
+
+def test_stream_and_in_memory_merge_are_byte_identical(tmp_path):
+    folder = tmp_path / "seq"
+    atlas_tool.generate_sequence(str(folder), 64, (200, 150), 0.5)
+    results = {}
+    for stream in (False, True):
+        output_dir = tmp_path / f"out_{stream}"
+        output_dir.mkdir()
+        save_path = atlas_tool.merge_folder(str(folder), str(output_dir), stream=stream)[0]
+        with open(save_path, "rb") as f:
+            results[stream] = f.read()
+    assert results[False] == results[True]
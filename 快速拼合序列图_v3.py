@@ -1,63 +1,114 @@
 import os
+import sys
+import glob
 import math
 import re
+import time
+import json
+import struct
+import hashlib
+import collections
+import zlib
+import argparse
+import threading
+import concurrent.futures
+import multiprocessing
 import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
+from tkinter import filedialog, messagebox, simpledialog, ttk
+import numpy as np
+from PIL import Image, ImageDraw, ImageTk
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.rgba', '.exr')
+# 白转透明：纯白色(255,255,255)转换为完全透明
+WHITE_KEY = {"key_color": (255, 255, 255), "tolerance": 0, "softness": 0, "luminance": False}
 
 def natural_sort_key(s):
     """自然排序key函数，支持数字序号"""
     return [int(text) if text.isdigit() else text.lower() for text in re.split(r'(\d+)', s)]
 
-def factorize(n):
-    """分解质因数并生成所有可能的排列组合"""
-    factors = []
-    i = 2
-    while i <= n:
-        if n % i == 0:
-            factors.append(i)
-            n = n // i
+def next_power_of_two(n):
+    return 1 << max(0, int(n - 1).bit_length())
+
+def prev_power_of_two(n):
+    return 1 << max(0, int(n).bit_length() - 1)
+
+def evaluate_layout(num, frame_size, rows, cols, max_size=16384, power_of_two=False, allow_downscale=True):
+    """计算一种行列组合的最终尺寸，返回评分最好的方案，放不下时返回 None
+    
+    超过 max_size 时按比例缩小格子（allow_downscale=False 时直接放弃）；
+    power_of_two=True 时纹理补齐到 2 的幂，并额外尝试把格子缩小到恰好填满较小的 2 的幂，避免大量补边。
+    评分越低越好：浪费面积比例 + 缩小损失的像素比例 + 长宽比惩罚（纹理长宽每差一倍加 0.1），
+    避免质数帧数时为了零空白选出 13x1 这样的长条。
+    """
+    width, height = frame_size
+    fit = min(1.0, max_size / (cols * width), max_size / (rows * height))
+    if fit < 1 and not allow_downscale:
+        return None
+    scales = {fit}
+    if power_of_two and allow_downscale:
+        fit_w = prev_power_of_two(cols * width * fit) / (cols * width)
+        fit_h = prev_power_of_two(rows * height * fit) / (rows * height)
+        scales.update((min(fit, fit_w), min(fit, fit_h), min(fit, fit_w, fit_h)))
+    
+    best = None
+    for scale in scales:
+        cell_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        used_size = (cell_size[0] * cols, cell_size[1] * rows)
+        if power_of_two:
+            texture_size = (next_power_of_two(used_size[0]), next_power_of_two(used_size[1]))
         else:
-            i += 1
-    
-    # 生成所有可能的行列组合
-    unique_factors = list(set(factors))
-    combinations = set()
-    for i in range(1, len(factors)+1):
-        row = math.prod(factors[:i])
-        col = math.prod(factors[i:]) if factors[i:] else 1
-        combinations.add((row, col))
-        combinations.add((col, row))
-    
-    # 添加近似平方数排列
-    sqrt_num = int(math.sqrt(n))
-    if sqrt_num == 0:
-        sqrt_num = 1
-    combinations.add((sqrt_num, math.ceil(n/sqrt_num)))
-    
-    return sorted(combinations, key=lambda x: abs(x[0]-x[1]) + x[0]*x[1])
-
-def get_layout_options(num):
-    """获取所有有效的布局选项"""
-    options = set()
-    # 精确因数分解
-    for i in range(1, num+1):
-        if num % i == 0:
-            options.add((i, num//i))
-    # 近似平方数
-    sqrt_num = int(num**0.5)
-    options.add((sqrt_num, sqrt_num + (1 if sqrt_num*sqrt_num < num else 0)))
-    # 质数处理
-    if len(options) == 0:
-        options.add((1, num))
-        options.add((math.ceil(num/2), 2))
-    return sorted(options, key=lambda x: (abs(x[0]-x[1]), x[0]*x[1]))
+            texture_size = used_size
+        if max(texture_size) > max_size:
+            continue
+        scale = cell_size[0] / width
+        waste = 1 - num * cell_size[0] * cell_size[1] / (texture_size[0] * texture_size[1])
+        score = waste + (1 - scale * scale) + 0.1 * abs(math.log2(texture_size[0] / texture_size[1]))
+        if best is None or score < best["score"]:
+            best = {"layout": (rows, cols), "cell_size": cell_size, "used_size": used_size,
+                    "texture_size": texture_size, "scale": scale, "waste": waste, "score": score}
+    return best
+
+def solve_layout(num, frame_size, max_size=16384, power_of_two=False, allow_downscale=True, limit=20):
+    """根据帧尺寸、最大纹理尺寸和 2 的幂要求为所有行列组合评分，返回最好的 limit 个方案
+    
+    每个行数只考虑放得下的最少列数（不留整行空白），每种组合 O(1) 计算，上千帧也能立即得到结果。
+    """
+    options = []
+    for rows in range(1, num + 1):
+        cols = math.ceil(num / rows)
+        if (rows - 1) * cols >= num:
+            continue
+        option = evaluate_layout(num, frame_size, rows, cols, max_size, power_of_two, allow_downscale)
+        if option is not None:
+            options.append(option)
+    options.sort(key=lambda o: (o["score"], abs(o["layout"][0] - o["layout"][1])))
+    return options[:limit] if limit else options
+
+def pick_layout(num, frame_size, rule="best", **solver_options):
+    """按规则选择布局方案：best 取评分最好的，square 取行列数最接近的，或固定的 '行x列'"""
+    if rule in ("best", "square"):
+        options = solve_layout(num, frame_size, limit=None, **solver_options)
+        if not options:
+            raise ValueError(f"{num} 帧在当前尺寸限制下放不下")
+        if rule == "square":
+            return min(options, key=lambda o: (abs(o["layout"][0] - o["layout"][1]), o["score"]))
+        return options[0]
+    match = re.fullmatch(r'\s*(\d+)\s*[xX×*]\s*(\d+)\s*', rule)
+    if not match:
+        raise ValueError(f"无法识别的布局规则：{rule}")
+    rows, cols = int(match.group(1)), int(match.group(2))
+    if rows * cols < num:
+        raise ValueError(f"布局 {rows}x{cols} 放不下 {num} 帧")
+    option = evaluate_layout(num, frame_size, rows, cols, **solver_options)
+    if option is None:
+        raise ValueError(f"布局 {rows}x{cols} 超过最大纹理尺寸")
+    return option
 
 def ask_layout_choice(options):
     """弹出布局选择对话框"""
     choice_window = tk.Toplevel()
     choice_window.title("选择排列方式")
-    choice_window.geometry("300x400")
+    choice_window.geometry("320x480")
     
     selected = [None]  # 使用列表实现闭包效果
     
@@ -79,12 +130,16 @@ def ask_layout_choice(options):
     canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
     canvas.configure(yscrollcommand=scrollbar.set)
     
-    for i, (rows, cols) in enumerate(options):
+    for i, option in enumerate(options):
+        rows, cols = option["layout"]
+        text = f"{rows} 行 × {cols} 列 （共 {rows*cols} 格）\n{option['texture_size'][0]}x{option['texture_size'][1]}"
+        if option["scale"] < 1:
+            text += f"，缩小到 {option['scale']:.0%}"
         btn = tk.Button(
             scrollable_frame,
-            text=f"{rows} 行 × {cols} 列 （共 {rows*cols} 格）",
+            text=text,
             width=30,
-            command=lambda r=rows, c=cols: [selected.__setitem__(0, (r,c)), choice_window.destroy()],
+            command=lambda o=option: [selected.__setitem__(0, o), choice_window.destroy()],
             relief=tk.GROOVE
         )
         btn.pack(pady=2, padx=20, fill=tk.X)
@@ -95,27 +150,719 @@ def ask_layout_choice(options):
     choice_window.wait_window()
     return selected[0]
 
+# 免解码的原始帧格式：带文件头的原始 RGBA（见 write_raw_rgba）和无压缩的 EXR，通过内存映射读取
+RAW_FRAME_EXTENSIONS = ('.rgba', '.exr')
+
+EXR_MAGIC = 20000630
+EXR_PIXEL_TYPES = {0: "<u4", 1: "<f2", 2: "<f4"}  # UINT、HALF、FLOAT
+
+def is_raw_frame(path):
+    return path.lower().endswith(RAW_FRAME_EXTENSIONS)
+
+def raw_frame_size(path):
+    """只读取文件头获取原始帧的尺寸"""
+    if path.lower().endswith(".exr"):
+        with open(path, "rb") as f:
+            header = _read_exr_header(f)
+        return header["width"], header["height"]
+    with open(path, "rb") as f:
+        magic, width, height = struct.unpack("<8sII", f.read(16))
+    if magic != RAW_RGBA_MAGIC:
+        raise ValueError(f"{os.path.basename(path)} 不是原始 RGBA 文件")
+    return width, height
+
+def read_raw_frame(path):
+    """把原始帧读成 (高, 宽, 4) 的 uint8 数组
+    
+    .rgba 直接返回内存映射的视图，不复制；EXR 的各通道也是内存映射的视图，只在转换到 8 位时读取一遍。
+    """
+    if path.lower().endswith(".exr"):
+        return read_exr(path)
+    width, height = raw_frame_size(path)
+    return np.memmap(path, dtype=np.uint8, mode="r", offset=16, shape=(height, width, 4))
+
+def _read_exr_header(f):
+    """解析 EXR 文件头，只支持单部分、扫描线、无压缩的文件"""
+    magic, version = struct.unpack("<ii", f.read(8))
+    if magic != EXR_MAGIC:
+        raise ValueError("不是 EXR 文件")
+    if version & 0x1a00:  # 分块、深度、多部分
+        raise ValueError("只支持扫描线 EXR")
+    
+    def read_cstring():
+        chars = bytearray()
+        while True:
+            c = f.read(1)
+            if not c:
+                raise ValueError("EXR 文件头不完整")
+            if c == b"\0":
+                return chars.decode("latin-1")
+            chars += c
+    
+    header = {}
+    while True:
+        name = read_cstring()
+        if not name:
+            break
+        attr_type = read_cstring()
+        size, = struct.unpack("<i", f.read(4))
+        value = f.read(size)
+        if name == "channels":
+            channels = []
+            pos = 0
+            while value[pos:pos + 1] != b"\0":
+                end = value.index(b"\0", pos)
+                pixel_type, = struct.unpack_from("<i", value, end + 1)
+                channels.append((value[pos:end].decode("latin-1"), pixel_type))
+                pos = end + 1 + 16
+            header["channels"] = channels
+        elif name == "compression":
+            header["compression"] = value[0]
+        elif name == "dataWindow":
+            x_min, y_min, x_max, y_max = struct.unpack("<iiii", value)
+            header["width"], header["height"] = x_max - x_min + 1, y_max - y_min + 1
+    if header.get("compression") != 0:
+        raise ValueError("只支持无压缩的 EXR，请在渲染器中关闭压缩")
+    header["data_start"] = f.tell() + 8 * header["height"]  # 跳过每行一个的偏移表
+    return header
+
+def read_exr(path):
+    """内存映射无压缩扫描线 EXR，转换为 8 位 RGBA
+    
+    每行是 (y, 字节数, 按通道名排序的各通道数据)，用结构化 dtype 一次映射全部行；
+    颜色按 alpha 反预乘后做 sRGB 编码，alpha 线性映射到 0~255。
+    """
+    with open(path, "rb") as f:
+        header = _read_exr_header(f)
+        width, height = header["width"], header["height"]
+        f.seek(header["data_start"] - 8 * height)
+        offsets = np.frombuffer(f.read(8 * height), dtype="<u8")
+    fields = [("y", "<i4"), ("size", "<i4")]
+    for name, pixel_type in header["channels"]:
+        if pixel_type not in EXR_PIXEL_TYPES:
+            raise ValueError(f"EXR 通道 {name} 的像素类型未知")
+        fields.append((name, EXR_PIXEL_TYPES[pixel_type], (width,)))
+    line = np.dtype(fields)
+    expected = header["data_start"] + line.itemsize * np.arange(height, dtype=np.uint64)
+    if not np.array_equal(offsets, expected):
+        raise ValueError("EXR 扫描线不是按顺序连续存放的")
+    lines = np.memmap(path, dtype=line, mode="r", offset=header["data_start"], shape=(height,))
+    names = {name.split(".")[-1]: name for name, _ in header["channels"]}
+    
+    out = np.empty((height, width, 4), dtype=np.uint8)
+    alpha = lines[names["A"]] if "A" in names else None
+    color = [lines[names[c]] if c in names else lines[names["Y"]] if "Y" in names else None for c in "RGB"]
+    if alpha is None and all(c is not None and c.dtype == np.float16 for c in color):
+        # 没有 alpha 的半精度：直接查表，不做浮点运算
+        lut = _half_lut("srgb")
+        for i, channel in enumerate(color):
+            out[..., i] = lut[channel.view(np.uint16)]
+        out[..., 3] = 255
+        return out
+    lut = _half_lut("srgb")
+    a = np.ones((height, width), dtype=np.float32) if alpha is None else np.asarray(alpha, dtype=np.float32)
+    visible = a > 0
+    safe = np.where(visible, a, 1)
+    for i, channel in enumerate(color):
+        if channel is None:
+            out[..., i] = 0
+            continue
+        straight = np.where(visible, np.asarray(channel, dtype=np.float32) / safe, 0)
+        out[..., i] = lut[straight.astype(np.float16).view(np.uint16)]
+    out[..., 3] = _half_lut("linear")[a.astype(np.float16).view(np.uint16)]
+    return out
+
+_HALF_LUTS = {}
+
+def _half_lut(curve):
+    """半精度浮点（按 uint16 位模式索引）到 8 位的查找表：srgb 为 sRGB 编码，linear 为线性截断"""
+    lut = _HALF_LUTS.get(curve)
+    if lut is None:
+        values = np.arange(65536, dtype=np.uint16).view(np.float16).astype(np.float32)
+        values = np.clip(np.nan_to_num(values, nan=0.0), 0, 1)
+        if curve == "srgb":
+            values = np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+        lut = _HALF_LUTS[curve] = np.rint(values * 255).astype(np.uint8)
+    return lut
+
+def list_image_files(folder_path):
+    """列出文件夹中支持的图片，按自然顺序排列"""
+    return sorted([f for f in os.listdir(folder_path)
+                   if f.lower().endswith(IMAGE_EXTENSIONS)], key=natural_sort_key)
+
+class FrameStore:
+    """序列帧仓库：按需解码，不保留全分辨率帧（拼合和保存时逐帧解码后直接复制进图集），
+    预览缩略图放在有内存上限的缓存中，供预览、颠倒、填充等操作共用
+    
+    crop 为 (左, 上, 右, 下) 时，所有取出的帧（包括缩略图）都先裁切到该区域；
+    resize 为 (宽, 高) 时，裁切后再缩放到该尺寸；
+    gutter 大于 0 时最后在四周复制边缘像素扩出 gutter 像素，避免过滤和 mip 时采到相邻格子；
+    blends 为每帧的 (下一帧文件名, 权重) 或 None，取帧时与下一帧按权重交叉淡化（见 resampled）。
+    """
+    
+    def __init__(self, folder_path, image_files, thumbs=None, crop=None, resize=None, gutter=0, blends=None):
+        self.folder_path = folder_path
+        self.image_files = list(image_files)
+        self.crop = crop
+        self.resize = resize
+        self.gutter = gutter
+        self.blends = blends
+        self._thumbs = ThumbnailCache() if thumbs is None else thumbs  # (帧标识, 尺寸) -> 预览缩略图
+    
+    def __len__(self):
+        return len(self.image_files)
+    
+    def path(self, idx):
+        return os.path.join(self.folder_path, self.image_files[idx])
+    
+    def blend(self, idx):
+        """第 idx 帧的交叉淡化参数 (下一帧文件名, 权重)，不混合时为 None"""
+        return self.blends[idx] if self.blends else None
+    
+    def frame_id(self, idx):
+        """缩略图缓存用的帧标识：文件路径，混合帧再加上下一帧和权重"""
+        blend = self.blend(idx)
+        return self.path(idx) if blend is None else (self.path(idx),) + blend
+    
+    def decode(self, idx):
+        """解码一帧（裁切、缩放、扩边、混合后）的 RGBA 图像，不缓存"""
+        img = self._load(self.path(idx))
+        blend = self.blend(idx)
+        if blend:
+            img = cross_fade(img, self._load(os.path.join(self.folder_path, blend[0])), blend[1])
+        return img
+    
+    def _load(self, path, draft_size=None):
+        """读取并转换一个文件；原始帧从内存映射构造，其他格式用 PIL 解码（可按 draft_size 缩小解码）"""
+        if is_raw_frame(path):
+            img = self._convert(Image.fromarray(read_raw_frame(path)))
+        else:
+            with Image.open(path) as src:
+                if draft_size and self.crop is None:
+                    src.draft("RGB", draft_size)
+                img = self._convert(src)
+        IO_STATS.add(frames_decoded=1, bytes_read=os.path.getsize(path))
+        return img
+    
+    def plane(self, idx, source="L"):
+        """取一帧的单通道 (高, 宽) uint8 平面：source 为 L（亮度）或 R/G/B/A 中的一个通道
+        
+        不需要裁切、缩放、扩边、混合的普通图片直接让 PIL 解码成单通道，原始帧从内存映射的视图中取，
+        都不生成中间的 RGBA 帧；亮度与 PIL 的 convert("L") 一致。
+        """
+        path = self.path(idx)
+        plain = not (self.crop or self.resize or self.gutter or self.blend(idx))
+        if plain and not is_raw_frame(path):
+            with Image.open(path) as src:
+                if source == "L":
+                    img = src.convert("L")
+                elif source in src.getbands():
+                    img = src.getchannel(source)
+                elif source == "A":
+                    img = Image.new("L", src.size, 255)  # 没有 alpha 时视为不透明
+                else:
+                    img = src.convert("RGB").getchannel(source)
+            IO_STATS.add(frames_decoded=1, bytes_read=os.path.getsize(path))
+            return np.asarray(img)
+        array = self.frame_array(idx)
+        if source != "L":
+            return array[..., "RGBA".index(source)]
+        rgb = array[..., :3].astype(np.uint32)
+        return ((rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+    
+    def frame_array(self, idx):
+        """取一帧的 (高, 宽, 4) uint8 数组
+        
+        原始帧且不需要缩放、扩边、混合时直接返回内存映射的视图（裁切也只是切片），拼合时从文件直接复制到图集；
+        其他情况等同于 np.asarray(decode(idx))。
+        """
+        if is_raw_frame(self.path(idx)) and not (self.resize or self.gutter or self.blend(idx)):
+            array = read_raw_frame(self.path(idx))
+            IO_STATS.add(frames_decoded=1, bytes_read=array.nbytes)
+            if self.crop:
+                left, top, right, bottom = self.crop
+                array = array[top:bottom, left:right]
+            return array
+        return np.asarray(self.decode(idx))
+    
+    def _convert(self, src):
+        img = src.convert("RGBA")
+        if self.crop:
+            img = img.crop(self.crop)
+        if self.resize and img.size != self.resize:
+            img = img.resize(self.resize, Image.LANCZOS)
+        if self.gutter:
+            g = self.gutter
+            img = Image.fromarray(np.pad(np.asarray(img), ((g, g), (g, g), (0, 0)), mode="edge"))
+        return img
+    
+    def source_size(self, idx=0):
+        """只读取文件头获取原始尺寸，不解码像素"""
+        if is_raw_frame(self.path(idx)):
+            return raw_frame_size(self.path(idx))
+        with Image.open(self.path(idx)) as img:
+            return img.size
+    
+    def frame_size(self, idx=0):
+        """取出的帧的尺寸（裁切、缩放、扩边后），不解码像素"""
+        width, height = self.content_size(idx)
+        return width + 2 * self.gutter, height + 2 * self.gutter
+    
+    def content_size(self, idx=0):
+        """不含扩边的帧尺寸"""
+        if self.resize:
+            return self.resize
+        if self.crop:
+            left, top, right, bottom = self.crop
+            return right - left, bottom - top
+        return self.source_size(idx)
+    
+    def check_sizes(self):
+        """逐个读取文件头，确认所有帧可识别且尺寸一致，返回帧尺寸"""
+        size = self.source_size(0)
+        for idx in range(1, len(self)):
+            frame_size = self.source_size(idx)
+            if frame_size != size:
+                raise ValueError(f"{self.image_files[idx]} 的尺寸 {frame_size} 与第一帧 {size} 不一致")
+        return self.frame_size()
+    
+    def reversed(self):
+        """返回顺序颠倒的视图，与原仓库共享已解码的帧"""
+        return FrameStore(self.folder_path, self.image_files[::-1], thumbs=self._thumbs,
+                          crop=self.crop, resize=self.resize, gutter=self.gutter,
+                          blends=self.blends[::-1] if self.blends else None)
+    
+    def cropped(self, box):
+        """返回裁切到 box（原图坐标，见 trim_box）的新仓库，保持原有的缩放比例和扩边（缓存不共享）"""
+        resize = None
+        if self.resize:
+            left, top, right, bottom = self.crop or (0, 0) + self.source_size()
+            resize = (max(1, round((box[2] - box[0]) * self.resize[0] / (right - left))),
+                      max(1, round((box[3] - box[1]) * self.resize[1] / (bottom - top))))
+        return FrameStore(self.folder_path, self.image_files, crop=box, resize=resize, gutter=self.gutter,
+                          blends=self.blends)
+    
+    def resized(self, size):
+        """返回每帧（含扩边）缩放到 size 的新仓库（缓存不共享）"""
+        width, height = size
+        return FrameStore(self.folder_path, self.image_files, crop=self.crop,
+                          resize=(max(1, width - 2 * self.gutter), max(1, height - 2 * self.gutter)),
+                          gutter=self.gutter, blends=self.blends)
+    
+    def padded(self, gutter):
+        """返回每帧四周扩出 gutter 像素边缘的新仓库（缓存不共享）"""
+        return FrameStore(self.folder_path, self.image_files, crop=self.crop, resize=self.resize, gutter=gutter,
+                          blends=self.blends)
+    
+    def subset(self, indices):
+        """返回只包含指定帧的视图，与原仓库共享已解码的帧"""
+        return FrameStore(self.folder_path, [self.image_files[idx] for idx in indices], thumbs=self._thumbs, crop=self.crop, resize=self.resize, gutter=self.gutter,
+                          blends=[self.blends[idx] for idx in indices] if self.blends else None)
+    
+    def resampled(self, count, blend=False):
+        """返回重采样到 count 帧的视图，只会解码用到的帧
+        
+        第 j 帧取原序列中 j * 帧数 / count 处（保持总时长，适合循环）；blend=False 时取该位置之前最近的一帧，
+        blend=True 时与下一帧按小数部分交叉淡化。与原仓库共享已解码的帧。
+        """
+        if count < 1:
+            raise ValueError("目标帧数必须大于 0")
+        if blend and self.blends:
+            raise ValueError("混合过的序列不能再次混合重采样")
+        positions = np.arange(count) * len(self) / count
+        indices = np.floor(positions).astype(int)
+        frames = self.subset(indices.tolist())
+        if blend:
+            weights = positions - indices
+            frames.blends = [
+                (self.image_files[idx + 1], round(float(weight), 4)) if weight > 0 and idx + 1 < len(self) else None
+                for idx, weight in zip(indices, weights)
+            ]
+        return frames
+    
+    def find_duplicates(self, threshold=0, progress=None):
+        """查找重复帧，返回每帧的代表帧序号（与之重复的第一帧，不重复时是自己）
+        
+        threshold 为 0 时只合并像素完全相同的帧（按解码后的像素哈希）；大于 0 时还合并感知哈希
+        （预乘 alpha 亮度的 8x8 差值哈希）汉明距离不超过 threshold、且平均颜色相差不超过 8 的近似帧。
+        帧在线程池中并行解码且不进入缓存，哈希比较对所有代表帧向量化进行。
+        """
+        signatures = {}
+        def scan(idx):
+            img = self.decode(idx)
+            digest = hashlib.blake2b(img.tobytes(), digest_size=16).digest()
+            return digest, np.asarray(img.resize((9, 8), Image.BOX), dtype=np.float32)
+        
+        self._run_parallel(scan, range(len(self)), "计算帧哈希", progress, signatures.__setitem__)
+        thumbs = np.stack([signatures[idx][1] for idx in range(len(self))])
+        luma = (thumbs[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)) * thumbs[..., 3] / 255
+        hashes = np.packbits(luma[:, :, 1:] > luma[:, :, :-1], axis=-1).reshape(-1, 8).view(">u8")[:, 0]
+        colors = thumbs.mean(axis=(1, 2))
+        
+        representatives = []
+        exact = {}
+        unique = []
+        for idx in range(len(self)):
+            rep = exact.get(signatures[idx][0])
+            if rep is None and threshold > 0 and unique:
+                candidates = np.array(unique)
+                # 汉明距离：异或后按字节展开成位再求和（np.bitwise_count 需要 NumPy 2）
+                diff = (hashes[candidates] ^ hashes[idx]).view(np.uint8).reshape(-1, 8)
+                near = ((np.unpackbits(diff, axis=1).sum(axis=1) <= threshold)
+                        & (np.abs(colors[candidates] - colors[idx]).max(axis=1) <= 8))
+                if near.any():
+                    rep = int(candidates[np.argmax(near)])
+            if rep is None:
+                rep = idx
+                exact[signatures[idx][0]] = idx
+                unique.append(idx)
+            representatives.append(rep)
+        return representatives
+    
+    def trim_box(self, threshold=0, progress=None):
+        """扫描所有帧的 alpha，求出 alpha > threshold 的像素的并集包围盒 (左, 上, 右, 下)
+        
+        每帧用 numpy 按行、按列做 any 归约，帧在线程池中并行解码且不进入缓存；全透明时返回整帧。
+        结果总是原图坐标：缩放或扩边过的仓库在未缩放的帧上扫描。
+        """
+        if self.resize or self.gutter:
+            unscaled = FrameStore(self.folder_path, self.image_files, crop=self.crop, blends=self.blends)
+            return unscaled.trim_box(threshold, progress)
+        boxes = {}
+        def scan(idx):
+            visible = self.frame_array(idx)[..., 3] > threshold
+            rows = np.flatnonzero(visible.any(axis=1))
+            if rows.size == 0:
+                return None
+            cols = np.flatnonzero(visible.any(axis=0))
+            return cols[0], rows[0], cols[-1] + 1, rows[-1] + 1
+        
+        self._run_parallel(scan, range(len(self)), "扫描透明边界", progress, boxes.__setitem__)
+        found = [box for box in boxes.values() if box is not None]
+        if not found:
+            return self.crop or (0, 0) + self.source_size()
+        left, top = min(b[0] for b in found), min(b[1] for b in found)
+        right, bottom = max(b[2] for b in found), max(b[3] for b in found)
+        if self.crop:
+            # 已裁切过时换算回原图坐标
+            left, top, right, bottom = left + self.crop[0], top + self.crop[1], right + self.crop[0], bottom + self.crop[1]
+        return int(left), int(top), int(right), int(bottom)
+    
+    def thumbnail(self, idx, size):
+        """取一帧的预览缩略图并缓存，不保留全分辨率帧
+        
+        JPEG 用 draft 在解码时直接按比例缩小，其他格式解码后先用 reduce 做整数倍缩小，再精确缩放到 size。
+        """
+        key = (self.frame_id(idx), size)
+        thumb = self._thumbs.get(key)
+        if thumb is None:
+            if self.blend(idx):
+                img = self.decode(idx)
+            else:
+                img = self._load(self.path(idx), draft_size=size)
+            factor = min(img.width // size[0], img.height // size[1])
+            if factor > 1:
+                img = img.reduce(factor)
+            thumb = img if img.size == size else img.resize(size, Image.LANCZOS)
+            self._thumbs[key] = thumb
+        return thumb
+    
+    def cached_thumbnail(self, idx, size):
+        """已经生成的缩略图，没有时返回 None（不解码）"""
+        return self._thumbs.get((self.frame_id(idx), size))
+    
+    def preload_thumbnails(self, size, progress=None):
+        """用线程池并行生成所有帧的缩略图"""
+        missing = [idx for idx in range(len(self)) if (self.frame_id(idx), size) not in self._thumbs]
+        self._run_parallel(lambda idx: self.thumbnail(idx, size), missing, "生成缩略图", progress)
+    
+    def _run_parallel(self, func, indices, stage, progress, on_result=None):
+        if progress:
+            progress.start(stage, len(self), done=len(self) - len(indices))
+        pool = concurrent.futures.ThreadPoolExecutor()
+        try:
+            futures = {pool.submit(func, idx): idx for idx in indices}
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if on_result:
+                    on_result(futures[future], result)
+                if progress:
+                    progress.advance()
+        finally:
+            # 取消或出错时丢弃还没开始的任务
+            pool.shutdown(wait=True, cancel_futures=True)
+
+class ThumbnailCache:
+    """缩略图的 LRU 缓存：总像素字节数超过 max_bytes 时淘汰最久没用的，可在多个线程中同时读写"""
+    
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+    
+    def get(self, key, default=None):
+        with self._lock:
+            img = self._items.get(key)
+            if img is None:
+                return default
+            self._items.move_to_end(key)
+            return img
+    
+    def __setitem__(self, key, img):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= self._size(old)
+            self._items[key] = img
+            self.bytes += self._size(img)
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.bytes -= self._size(old)
+    
+    def __getstate__(self):
+        # 传给子进程时只带上限，缩略图和锁都不复制
+        return {"max_bytes": self.max_bytes}
+    
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+    
+    @staticmethod
+    def _size(img):
+        return img.width * img.height * len(img.getbands())
+
+def cross_fade(first, second, weight):
+    """两帧按 weight（0~1，second 的权重）交叉淡化，RGB 按 alpha 预乘后混合，避免透明边缘发黑"""
+    a = np.asarray(first, dtype=np.float32)
+    b = np.asarray(second, dtype=np.float32)
+    alpha = a[..., 3:] * (1 - weight) + b[..., 3:] * weight
+    premul = a[..., :3] * a[..., 3:] * (1 - weight) + b[..., :3] * b[..., 3:] * weight
+    rgb = np.where(alpha > 0, premul / np.maximum(alpha, 1e-6), a[..., :3] * (1 - weight) + b[..., :3] * weight)
+    return Image.fromarray(np.rint(np.concatenate([rgb, alpha], axis=-1)).clip(0, 255).astype(np.uint8))
+
+def resample_target(num):
+    """重采样的默认目标帧数（不超过 num）：优先取最大的 2 的幂方阵（4、16、64、256…），
+    它丢掉一半以上的帧时改取最大的方阵（如 13 帧 -> 3x3），不足 4 帧时保持原帧数
+    """
+    if num < 4:
+        return num
+    side = math.isqrt(num)
+    power = prev_power_of_two(side)
+    return power * power if power * power * 2 >= num else side * side
+
+class IOStats:
+    """进程内的读写计数：解码帧数、读取字节数、写出字节数（多线程安全）"""
+    
+    def __init__(self):
+        self.frames_decoded = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+    
+    def add(self, frames_decoded=0, bytes_read=0, bytes_written=0):
+        with self._lock:
+            self.frames_decoded += frames_decoded
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+    
+    def snapshot(self):
+        with self._lock:
+            return self.frames_decoded, self.bytes_read, self.bytes_written
+
+IO_STATS = IOStats()
+
+class JobReport:
+    """一次任务的分阶段统计：每个阶段的耗时、解码帧数、读写字节数和结束时的进程峰值内存
+    
+    begin 开始新阶段（自动结束上一个），end 结束当前阶段；读写数按 IO_STATS 在阶段前后的差值计算，
+    同一进程中同时运行的任务会计入彼此的读写。
+    """
+    
+    def __init__(self, title=""):
+        self.title = title
+        self.stages = []
+        self._current = None
+    
+    def begin(self, name):
+        self.end()
+        self._current = (name, time.perf_counter(), IO_STATS.snapshot())
+    
+    def end(self):
+        if self._current is None:
+            return
+        name, start, (frames, read, written) = self._current
+        now_frames, now_read, now_written = IO_STATS.snapshot()
+        self.stages.append({
+            "stage": name, "seconds": round(time.perf_counter() - start, 6),
+            "frames_decoded": now_frames - frames, "bytes_read": now_read - read,
+            "bytes_written": now_written - written, "peak_rss_mb": peak_rss_mb(),
+        })
+        self._current = None
+    
+    def to_dict(self):
+        return {
+            "title": self.title,
+            "seconds": round(sum(s["seconds"] for s in self.stages), 6),
+            "frames_decoded": sum(s["frames_decoded"] for s in self.stages),
+            "bytes_read": sum(s["bytes_read"] for s in self.stages),
+            "bytes_written": sum(s["bytes_written"] for s in self.stages),
+            "peak_rss_mb": max((s["peak_rss_mb"] or 0 for s in self.stages), default=None),
+            "stages": self.stages,
+        }
+    
+    def summary(self):
+        """多行文字摘要，用于预览窗口的统计面板"""
+        lines = [f"{self.title}："]
+        for s in self.stages:
+            lines.append(f"  {s['stage']}  {s['seconds']:.2f}s  解码 {s['frames_decoded']} 帧  "
+                         f"读 {s['bytes_read'] / (1 << 20):.1f}MB  写 {s['bytes_written'] / (1 << 20):.1f}MB  "
+                         f"峰值 {s['peak_rss_mb'] or 0:.0f}MB")
+        return "\n".join(lines)
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB），无法获取时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024  # macOS 单位是字节，Linux 是 KB
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+        
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = Counters(cb=ctypes.sizeof(Counters))
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / (1 << 20)
+    return None
+
+class TaskCancelled(Exception):
+    """后台任务被用户取消"""
+
+class Progress:
+    """后台任务的进度与取消状态：工作线程更新，界面线程轮询读取"""
+    
+    def __init__(self, report=None):
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+        self.bytes_written = 0
+        self.report = report or JobReport()  # 每次 start 开始一个统计阶段
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+    
+    def start(self, stage, total, done=0):
+        self.check()
+        self.stage, self.total, self.done = stage, total, done
+        self.bytes_written = 0
+        self.report.begin(stage)
+    
+    def advance(self, n=1, bytes_written=0):
+        with self._lock:
+            self.done += n
+            self.bytes_written += bytes_written
+        self.check()
+    
+    def cancel(self):
+        self._cancelled.set()
+    
+    def check(self):
+        """在工作线程中调用，已取消时抛出 TaskCancelled 结束任务"""
+        if self._cancelled.is_set():
+            raise TaskCancelled()
+    
+    def describe(self):
+        text = f"{self.stage} {self.done}/{self.total}"
+        if self.bytes_written:
+            text += f"，已写入 {self.bytes_written / (1 << 20):.1f} MB"
+        return text
+
+def run_in_background(title, work, on_done, report=None):
+    """在后台线程执行 work(progress)，显示进度条和取消按钮，完成后在界面线程调用 on_done(结果)
+    
+    report 为 JobReport 时，进度的每个阶段都记录到其中。
+    """
+    progress = Progress(report or JobReport(title))
+    dialog = tk.Toplevel()
+    dialog.title(title)
+    dialog.geometry("360x120")
+    dialog.protocol("WM_DELETE_WINDOW", progress.cancel)
+    
+    status = tk.Label(dialog, text="准备中…")
+    status.pack(pady=5)
+    bar = ttk.Progressbar(dialog, length=320, mode="determinate")
+    bar.pack(pady=5)
+    tk.Button(dialog, text="取消", command=progress.cancel, width=10).pack(pady=5)
+    
+    outcome = {}
+    def target():
+        try:
+            outcome["result"] = work(progress)
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            progress.report.end()
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    
+    # Tk 只能在主线程操作，工作线程的结果通过轮询送回界面
+    def poll():
+        if worker.is_alive():
+            status.config(text=progress.describe())
+            bar["maximum"] = max(progress.total, 1)
+            bar["value"] = progress.done
+            dialog.after(50, poll)
+            return
+        dialog.destroy()
+        error = outcome.get("error")
+        if isinstance(error, TaskCancelled):
+            return
+        if error is not None:
+            messagebox.showerror("处理错误", f"{title}时出错：{str(error)}")
+            return
+        on_done(outcome["result"])
+    dialog.after(50, poll)
+
 def select_folder():
     folder_path = filedialog.askdirectory()
     if not folder_path:
         return
     
-    image_files = sorted([f for f in os.listdir(folder_path) 
-                         if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))], key=natural_sort_key)
+    image_files = list_image_files(folder_path)
     
     if not image_files:
         messagebox.showerror("错误", "文件夹中没有找到图片文件")
         return
     
+    # 只读取文件头做检查，像素留到合并时再解码
+    frames = FrameStore(folder_path, image_files)
     try:
-        images = [Image.open(os.path.join(folder_path, img)).convert("RGBA") 
-                 for img in image_files]
+        frames.check_sizes()
     except Exception as e:
         messagebox.showerror("图像错误", f"无法读取图像文件：{str(e)}")
         return
     
+    choose_layout_and_merge(frames)
+
+def choose_layout_and_merge(frames):
+    """按帧数和帧尺寸求解布局，让用户选择后打开预览"""
     # 生成布局选项
-    layout_options = get_layout_options(len(image_files))
+    layout_options = solve_layout(len(frames), frames.frame_size())
     
     # 弹出选择窗口
     selected_layout = ask_layout_choice(layout_options)
@@ -123,38 +870,151 @@ def select_folder():
     if not selected_layout:
         return  # 用户取消选择
     
-    merge_images(folder_path, image_files, selected_layout)
+    if selected_layout["scale"] < 1:
+        frames = frames.resized(selected_layout["cell_size"])
+    merge_images(frames, selected_layout["layout"])
+
+def frame_remap(cells, representatives):
+    """原始帧到格子的映射表：每一帧（重复帧按其代表帧）所在的格子，不在图集中时为 None"""
+    cell_of = {}
+    for cell, idx in enumerate(cells):
+        if idx is not None:
+            cell_of.setdefault(idx, cell)
+    return [cell_of.get(rep) for rep in representatives]
 
-def merge_images(folder_path, image_files, layout):
+def default_cells(num_images, layout):
+    """每个格子对应的帧序号，空白格为 None"""
     rows, cols = layout
-    num_images = len(image_files)
+    return [idx if idx < num_images else None for idx in range(rows * cols)]
+
+def compose_atlas(frames, layout, progress=None, cells=None):
+    """按行列布局把帧拼到一张透明画布上（不依赖界面）；cells 指定每格放哪一帧，默认按顺序
     
-    try:
-        images = [Image.open(os.path.join(folder_path, img)).convert("RGBA") 
-                 for img in image_files]
-        width, height = images[0].size
-        
-        # 创建画布（自动适配宽高比）
-        new_image = Image.new('RGBA', 
-                            (width * cols, height * rows), 
-                            (0, 0, 0, 0))
-        
-        # 粘贴图片
-        for idx in range(rows * cols):
-            row = idx // cols
-            col = idx % cols
-            if idx < num_images:
-                new_image.paste(images[idx], (col * width, row * height))
-            else:
-                transparent_img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-                new_image.paste(transparent_img, (col * width, row * height))
-        
-        preview_image(new_image, width, height, rows, cols, num_images, images[0], folder_path, image_files)
-        
-    except Exception as e:
-        messagebox.showerror("处理错误", f"合并图像时出错：{str(e)}")
+    与 iter_atlas_bands 一样用 frame_array 取帧直接复制进画布数组，原始帧从内存映射复制，不经过 PIL 图像。
+    """
+    rows, cols = layout
+    width, height = frames.frame_size()
+    if cells is None:
+        cells = default_cells(len(frames), layout)
+    if progress:
+        progress.start("拼合", len(cells))
+    
+    # 创建画布（自动适配宽高比），空白格保持透明
+    canvas = np.zeros((height * rows, width * cols, 4), dtype=np.uint8)
+    for idx, frame_idx in enumerate(cells):
+        if frame_idx is not None:
+            x, y = (idx % cols) * width, (idx // cols) * height
+            canvas[y:y + height, x:x + width] = frames.frame_array(frame_idx)
+        if progress:
+            progress.advance()
+    return Image.fromarray(canvas)
+
+def iter_atlas_bands(frames, layout, cells=None):
+    """逐行生成图集：每次只解码一行格子的帧，产出 (帧高, 帧宽*列数, 4) 的 uint8 数组"""
+    rows, cols = layout
+    width, height = frames.frame_size()
+    if cells is None:
+        cells = default_cells(len(frames), layout)
+    for row in range(rows):
+        band = np.zeros((height, width * cols, 4), dtype=np.uint8)
+        for col in range(cols):
+            frame_idx = cells[row * cols + col]
+            if frame_idx is not None:
+                band[:, col * width:(col + 1) * width] = frames.frame_array(frame_idx)
+        yield band
 
-def preview_image(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files):
+def merge_images(frames, layout, cells=None, key=None):
+    """后台生成缩略图后打开预览，全分辨率图集留到保存时再生成"""
+    thumb_size = preview_cell_size(frames.frame_size(), layout)
+    report = JobReport("生成预览")
+    run_in_background("合并图像", lambda progress: frames.preload_thumbnails(thumb_size, progress),
+                      lambda _: preview_image(frames, layout, cells, key, report), report)
+
+def preview_cell_size(frame_size, layout, max_size=1080):
+    """预览中每个格子的尺寸：整张预览限制在 max_size 内"""
+    rows, cols = layout
+    width, height = frame_size
+    scale = min(max_size/(width*cols), max_size/(height*rows), 1)
+    return max(1, int(width*scale)), max(1, int(height*scale))
+
+class CellAtlas:
+    """图集的格子模型：记录每个格子放哪一帧，并跟踪需要重新绘制的脏格子
+    
+    颠倒、填充、往返、抽帧、交换都只修改 cells，render 时只重新绘制变化的格子。
+    """
+    
+    def __init__(self, num_frames, layout, cells=None):
+        self.num_frames = num_frames
+        self.rows, self.cols = layout
+        self.cells = list(cells) if cells is not None else default_cells(num_frames, layout)
+        self.dirty = set(range(len(self.cells)))
+    
+    @property
+    def layout(self):
+        return self.rows, self.cols
+    
+    def sequence(self):
+        """按格子顺序排列的帧序号（不含空白格）"""
+        return [idx for idx in self.cells if idx is not None]
+    
+    def set_cells(self, cells):
+        """替换格子内容，只把内容变化的格子标记为脏"""
+        self.dirty.update(i for i, (old, new) in enumerate(zip(self.cells, cells)) if old != new)
+        self.cells = list(cells)
+    
+    def set_sequence(self, sequence):
+        """把帧序列从第一格开始依次摆放，其余格子留空"""
+        if len(sequence) > len(self.cells):
+            raise ValueError(f"需要 {len(sequence)} 个格子，当前布局只有 {len(self.cells)} 个")
+        self.set_cells(list(sequence) + [None] * (len(self.cells) - len(sequence)))
+    
+    def reverse_order(self):
+        """颠倒图片排列顺序"""
+        self.set_sequence(self.sequence()[::-1])
+    
+    def auto_fill(self):
+        """使用第一张图片填充空白"""
+        first = next((idx for idx in self.cells if idx is not None), None)
+        self.set_cells([first if idx is None else idx for idx in self.cells])
+    
+    def ping_pong(self):
+        """往返播放：正序之后接倒序（首尾帧不重复）"""
+        sequence = self.sequence()
+        self.set_sequence(sequence + sequence[-2:0:-1])
+    
+    def skip_frames(self, step):
+        """抽帧：每 step 帧保留一帧"""
+        self.set_sequence(self.sequence()[::step])
+    
+    def swap(self, a, b):
+        """交换两个格子的内容"""
+        cells = list(self.cells)
+        cells[a], cells[b] = cells[b], cells[a]
+        self.set_cells(cells)
+    
+    def render(self, canvas, cell_size, image_for):
+        """把脏格子重新绘制到 canvas 上，image_for(帧序号) 返回该格要贴的图，返回重绘的格子数"""
+        width, height = cell_size
+        blank = Image.new('RGBA', cell_size, (0, 0, 0, 0))
+        dirty, self.dirty = sorted(self.dirty), set()
+        for idx in dirty:
+            box = ((idx % self.cols) * width, (idx // self.cols) * height)
+            frame_idx = self.cells[idx]
+            canvas.paste(blank if frame_idx is None else image_for(frame_idx), box)
+        return len(dirty)
+
+def preview_image(frames, layout, cells=None, key=None, report=None):
+    rows, cols = layout
+    num_images = len(frames)
+    width, height = frames.frame_size()
+    thumb_size = preview_cell_size((width, height), layout)
+    # 当前图集状态：格子模型，以及保存时要应用的抠像参数
+    atlas = CellAtlas(num_images, layout, cells)
+    state = {"key": key, "selected": None, "representatives": None}
+    profile_var = tk.StringVar(value="balanced")
+    motion_var = tk.BooleanVar(value=False)
+    canvas = Image.new('RGBA', (thumb_size[0] * cols, thumb_size[1] * rows), (0, 0, 0, 0))
+    
     root = tk.Toplevel()
     root.title(f"预览合并图像 ({rows}x{cols})")
     
@@ -166,22 +1026,39 @@ def preview_image(new_image, width, height, rows, cols, num_images, first_image,
     img_frame = tk.Frame(root)
     img_frame.grid(row=0, column=0, sticky="nsew")
     
-    # 创建显示用的缩放副本（保持原始图像不变）
-    display_image = new_image.copy()
+    label = tk.Label(img_frame)
+    label.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
     
-    # 计算缩放比例
-    max_size = 1080
-    original_width, original_height = display_image.size
-    scale = min(max_size/original_width, max_size/original_height, 1)
+    def refresh():
+        """只把变化的格子重新贴到缩略图画布上，再刷新显示"""
+        atlas.render(canvas, thumb_size, lambda idx: frames.thumbnail(idx, thumb_size))
+        display_image = canvas if state["key"] is None else key_alpha(canvas, **state["key"])
+        if state["selected"] is not None:
+            display_image = display_image.copy()
+            x, y = (state["selected"] % cols) * thumb_size[0], (state["selected"] // cols) * thumb_size[1]
+            ImageDraw.Draw(display_image).rectangle(
+                (x, y, x + thumb_size[0] - 1, y + thumb_size[1] - 1), outline=(255, 0, 0, 255), width=2)
+        new_image_tk = ImageTk.PhotoImage(display_image)
+        label.config(image=new_image_tk)
+        label.image = new_image_tk
     
-    # 生成预览尺寸
-    preview_size = (int(original_width*scale), int(original_height*scale))
-    display_image = display_image.resize(preview_size, Image.LANCZOS)
+    def on_click(event):
+        """点击两个格子交换它们的内容"""
+        # 图像在标签中居中显示，先换算到图像坐标
+        x = event.x - (label.winfo_width() - canvas.width) // 2
+        y = event.y - (label.winfo_height() - canvas.height) // 2
+        if not (0 <= x < canvas.width and 0 <= y < canvas.height):
+            return
+        cell = (y // thumb_size[1]) * cols + x // thumb_size[0]
+        if state["selected"] is None:
+            state["selected"] = cell
+        else:
+            atlas.swap(state["selected"], cell)
+            state["selected"] = None
+        refresh()
     
-    new_image_tk = ImageTk.PhotoImage(display_image)
-    label = tk.Label(img_frame, image=new_image_tk)
-    label.image = new_image_tk
-    label.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+    label.bind("<Button-1>", on_click)
+    refresh()
     
     # 信息面板
     info_frame = tk.Frame(root)
@@ -192,20 +1069,101 @@ def preview_image(new_image, width, height, rows, cols, num_images, first_image,
         f"原始分辨率：{width}x{height}\n"
         f"合并后分辨率：{width*cols}x{height*rows}\n"
         f"排列方式：{rows}行 × {cols}列\n"
-        f"总单元格：{rows*cols}个"
+        f"总单元格：{rows*cols}个\n"
+        f"点击两个格子可交换位置"
     )
     tk.Label(info_frame, text=info_text, justify=tk.LEFT).pack(side=tk.LEFT)
     
+    # 统计面板：显示最近几次后台任务的分阶段耗时、读写量和峰值内存
+    reports = [report] if report else []
+    stats_var = tk.BooleanVar(value=False)
+    stats_label = tk.Label(info_frame, justify=tk.LEFT, font=("Courier", 9))
+    
+    def show_report(new_report=None, save_path=None):
+        if new_report is not None:
+            reports.append(new_report)
+        if stats_var.get():
+            stats_label.config(text="\n".join(r.summary() for r in reports[-3:]))
+            stats_label.pack(side=tk.LEFT, padx=10)
+            if save_path:
+                # 显示统计时，保存图像的同时把全部统计写入同名 .report.json
+                with open(os.path.splitext(save_path)[0] + ".report.json", "w", encoding="utf-8") as f:
+                    json.dump([r.to_dict() for r in reports], f, ensure_ascii=False, indent=2)
+        else:
+            stats_label.pack_forget()
+    
+    tk.Checkbutton(info_frame, text="显示统计", variable=stats_var,
+                   command=show_report).pack(side=tk.LEFT, anchor=tk.N, padx=10)
+    
+    def update(operation, *args):
+        try:
+            operation(*args)
+        except ValueError as e:
+            messagebox.showerror("处理错误", str(e))
+            return
+        state["selected"] = None
+        refresh()
+    
+    def ask_skip():
+        step = simpledialog.askinteger("抽帧", "每几帧保留一帧：", minvalue=2, parent=root)
+        if step:
+            update(atlas.skip_frames, step)
+    
+    def set_key(key):
+        state["key"] = key
+        refresh()
+    
+    def trim_frames():
+        """后台扫描透明边界后，用裁切后的帧重新打开预览"""
+        def done(box):
+            root.destroy()
+            merge_images(frames.cropped(box), layout, atlas.cells, state["key"])
+        run_in_background("裁切空白", lambda progress: frames.trim_box(progress=progress), done)
+    
+    def resample_frames():
+        """重采样到指定帧数（可混合相邻帧），重新选择布局后打开新的预览"""
+        count = simpledialog.askinteger("重采样", "目标帧数：", initialvalue=resample_target(len(frames)),
+                                        minvalue=1, parent=root)
+        if not count:
+            return
+        blend = messagebox.askyesno("重采样", "是否混合相邻帧（交叉淡化）？\n选“否”则直接抽帧。", parent=root)
+        try:
+            resampled = frames.resampled(count, blend)
+        except ValueError as e:
+            messagebox.showerror("处理错误", str(e))
+            return
+        root.destroy()
+        choose_layout_and_merge(resampled)
+    
+    def dedup_frames():
+        """后台查找重复帧，每个重复组只保留第一帧，保存时附带原始帧到格子的映射表"""
+        threshold = simpledialog.askinteger("去重", "近似阈值（0 表示只合并完全相同的帧）：",
+                                            initialvalue=0, minvalue=0, maxvalue=64, parent=root)
+        if threshold is None:
+            return
+        dedup_report = JobReport("去重")
+        def done(representatives):
+            state["representatives"] = representatives
+            update(atlas.set_sequence, sorted(set(representatives)))
+            show_report(dedup_report)
+        run_in_background("去重", lambda progress: frames.find_duplicates(threshold, progress), done, dedup_report)
+    
     # 操作按钮
     btn_frame = tk.Frame(root)
     btn_frame.grid(row=2, column=0, sticky="ew")
     
     tk.Button(btn_frame, text="保存", 
-             command=lambda: save_merged_image(new_image),  # 这里仍然使用原始图像
+             command=lambda: save_merged_image(frames, layout, atlas.cells, state["key"], profile_var.get(),
+                                               state["representatives"], show_report, motion_var.get()),  # 保存时才生成原图
              width=10).pack(side=tk.LEFT, padx=5)
     
+    # 保存配置：fast 用于快速迭代，release 压缩率最高
+    tk.OptionMenu(btn_frame, profile_var, *SAVE_PROFILES).pack(side=tk.LEFT, padx=5)
+    # 勾选后保存时另存同布局的运动矢量图集
+    tk.Checkbutton(btn_frame, text="运动矢量", variable=motion_var).pack(side=tk.LEFT, padx=5)
+    
     tk.Button(btn_frame, text="自动填充", 
-             command=lambda: auto_fill(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files),
+             command=lambda: update(atlas.auto_fill),
              width=10).pack(side=tk.LEFT, padx=5)
     
     tk.Button(btn_frame, text="重新选择", 
@@ -213,63 +1171,1917 @@ def preview_image(new_image, width, height, rows, cols, num_images, first_image,
              width=10).pack(side=tk.LEFT, padx=5)
     
     tk.Button(btn_frame, text="颠倒顺序", 
-             command=lambda: reverse_order(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files),
+             command=lambda: update(atlas.reverse_order),
+             width=10).pack(side=tk.LEFT, padx=5)
+    
+    tk.Button(btn_frame, text="往返播放", 
+             command=lambda: update(atlas.ping_pong),
+             width=10).pack(side=tk.LEFT, padx=5)
+    
+    tk.Button(btn_frame, text="抽帧", 
+             command=ask_skip,
              width=10).pack(side=tk.LEFT, padx=5)
     
     tk.Button(btn_frame, text="白转透明", 
-         command=lambda: apply_white_transparent(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files, root),
+         command=lambda: set_key(WHITE_KEY),
          width=10).pack(side=tk.LEFT, padx=5)
-# 新增函数：颠倒顺序
-def reverse_order(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files):
-    """颠倒图片排列顺序并刷新预览"""
-    try:
-        # 颠倒图片文件顺序
-        reversed_image_files = image_files[::-1]
-        
-        # 重新创建画布
-        reversed_image = Image.new('RGBA', (width * cols, height * rows), (0, 0, 0, 0))
-        
-        # 颠倒顺序粘贴图片
-        for idx in range(rows * cols):
-            row = idx // cols
-            col = idx % cols
-            if idx < num_images:
-                img_path = os.path.join(folder_path, reversed_image_files[idx])
-                img = Image.open(img_path).convert("RGBA")
-                reversed_image.paste(img, (col * width, row * height))
-            else:
-                transparent_img = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-                reversed_image.paste(transparent_img, (col * width, row * height))
-        
-        # 刷新预览
-        preview_image(reversed_image, width, height, rows, cols, num_images, first_image, folder_path, reversed_image_files)
-    except Exception as e:
-        messagebox.showerror("处理错误", f"颠倒顺序时出错：{str(e)}")
-
-def auto_fill(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files):
-    """使用第一张图片填充空白"""
-    for idx in range(rows * cols):
-        if idx >= num_images:
-            row = idx // cols
-            col = idx % cols
-            new_image.paste(first_image, (col * width, row * height))
-    preview_image(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files)
-
-def save_merged_image(new_image):
+    
+    tk.Button(btn_frame, text="裁切空白", 
+         command=trim_frames,
+         width=10).pack(side=tk.LEFT, padx=5)
+    
+    tk.Button(btn_frame, text="去重", 
+         command=dedup_frames,
+         width=10).pack(side=tk.LEFT, padx=5)
+    
+    tk.Button(btn_frame, text="重采样", 
+         command=resample_frames,
+         width=10).pack(side=tk.LEFT, padx=5)
+    
+    tk.Button(btn_frame, text="播放", 
+         command=lambda: play_animation(frames, atlas.sequence(), state["key"], thumb_size),
+         width=10).pack(side=tk.LEFT, padx=5)
+
+# 动画导出的文件类型，按扩展名选择编码
+ANIMATION_FILETYPES = [("APNG 动画", "*.png"), ("WebP 动画", "*.webp"), ("GIF 动画", "*.gif")]
+ANIMATION_FORMATS = {".png": "PNG", ".webp": "WEBP", ".gif": "GIF"}
+
+def animation_size(frame_size, max_side=256):
+    """播放和导出动画用的帧尺寸：长边不超过 max_side"""
+    width, height = frame_size
+    scale = min(max_side / max(width, height), 1)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def animation_frame(frames, idx, size, key=None):
+    """动画的一帧：缓存中的缩略图，需要时抠像"""
+    thumb = frames.thumbnail(idx, size)
+    return thumb if key is None else key_alpha(thumb, **key)
+
+def export_animation(frames, sequence, save_path, size, fps=30, key=None, progress=None):
+    """按 sequence 的顺序把缩略图导出为循环动画，扩展名决定格式（APNG、WebP、GIF）
+    
+    只使用 size 大小的缩略图，不生成全分辨率帧或图集。
+    """
+    ext = os.path.splitext(save_path)[1].lower()
+    if ext not in ANIMATION_FORMATS:
+        raise ValueError(f"不支持的动画格式：{ext}")
+    if progress:
+        progress.start("生成动画帧", len(sequence))
+    images = []
+    for idx in sequence:
+        images.append(animation_frame(frames, idx, size, key))
+        if progress:
+            progress.advance()
+    if progress:
+        progress.start("编码动画", 1)
+    options = {"save_all": True, "append_images": images[1:], "duration": max(1, round(1000 / fps)), "loop": 0}
+    if ext == ".webp":
+        options.update(quality=90, method=4)
+    elif ext == ".gif":
+        options["disposal"] = 2  # 每帧先清空，透明区域不残留上一帧
+    images[0].save(save_path, format=ANIMATION_FORMATS[ext], **options)
+    IO_STATS.add(bytes_written=os.path.getsize(save_path))
+    if progress:
+        progress.advance(bytes_written=os.path.getsize(save_path))
+    return save_path
+
+def checkerboard(size, tile=8):
+    """透明背景的棋盘格"""
+    width, height = size
+    y, x = np.mgrid[:height, :width]
+    gray = np.where((x // tile + y // tile) % 2, 200, 150).astype(np.uint8)
+    return Image.fromarray(np.dstack([gray, gray, gray, np.full_like(gray, 255)]))
+
+def play_animation(frames, sequence, key=None, fallback_size=None):
+    """动画播放窗口：按 sequence 的顺序循环播放，可调帧率、暂停，并导出 APNG/WebP/GIF
+    
+    帧来自有内存上限的缩略图缓存，后台线程按播放顺序预先生成；还没生成的帧先用 fallback_size 的预览网格缩略图
+    放大代替，打开即可播放，不会解码出全分辨率图集。
+    """
+    size = animation_size(frames.frame_size())
+    background = checkerboard(size)
+    state = {"pos": 0, "playing": True, "timer": None}
+    fps_var = tk.IntVar(value=30)
+    
+    root = tk.Toplevel()
+    root.title(f"播放预览（{len(sequence)} 帧）")
+    label = tk.Label(root)
+    label.pack(padx=10, pady=10)
+    status = tk.Label(root)
+    status.pack()
+    
+    # 后台按播放顺序生成缩略图，结果只放进缓存，不在任务里持有图像
+    pool = concurrent.futures.ThreadPoolExecutor()
+    for idx in dict.fromkeys(sequence):
+        pool.submit(lambda i: frames.thumbnail(i, size) and None, idx)
+    
+    def current_image():
+        idx = sequence[state["pos"]]
+        thumb = frames.cached_thumbnail(idx, size)
+        if thumb is None and fallback_size:
+            small = frames.cached_thumbnail(idx, fallback_size)
+            thumb = small.resize(size, Image.BILINEAR) if small is not None else None
+        if thumb is None:
+            return None
+        if key is not None:
+            thumb = key_alpha(thumb, **key)
+        return Image.alpha_composite(background, thumb.convert("RGBA"))
+    
+    def show():
+        image = current_image()
+        if image is None:
+            return False  # 这一帧还没准备好，停在上一帧
+        photo = ImageTk.PhotoImage(image)
+        label.config(image=photo)
+        label.image = photo
+        status.config(text=f"第 {state['pos'] + 1}/{len(sequence)} 帧（原帧 {sequence[state['pos']] + 1}）")
+        return True
+    
+    def tick():
+        if state["playing"] and show():
+            state["pos"] = (state["pos"] + 1) % len(sequence)
+        state["timer"] = root.after(max(1, round(1000 / max(1, fps_var.get()))), tick)
+    
+    def toggle():
+        state["playing"] = not state["playing"]
+        play_button.config(text="暂停" if state["playing"] else "播放")
+    
+    def step(delta):
+        if state["playing"]:
+            toggle()
+        state["pos"] = (state["pos"] + delta) % len(sequence)
+        show()
+    
+    def export():
+        save_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=ANIMATION_FILETYPES,
+                                                 initialfile="preview.png", parent=root)
+        if not save_path:
+            return
+        run_in_background("导出动画",
+                          lambda progress: export_animation(frames, sequence, save_path, size, fps_var.get(), key,
+                                                            progress),
+                          lambda path: messagebox.showinfo("导出成功", f"动画已保存至：\n{path}", parent=root))
+    
+    def close():
+        if state["timer"] is not None:
+            root.after_cancel(state["timer"])
+        pool.shutdown(wait=False, cancel_futures=True)
+        root.destroy()
+    
+    btn_frame = tk.Frame(root)
+    btn_frame.pack(pady=5)
+    tk.Button(btn_frame, text="上一帧", command=lambda: step(-1), width=8).pack(side=tk.LEFT, padx=5)
+    play_button = tk.Button(btn_frame, text="暂停", command=toggle, width=8)
+    play_button.pack(side=tk.LEFT, padx=5)
+    tk.Button(btn_frame, text="下一帧", command=lambda: step(1), width=8).pack(side=tk.LEFT, padx=5)
+    tk.Label(btn_frame, text="帧率").pack(side=tk.LEFT)
+    tk.Spinbox(btn_frame, from_=1, to=60, textvariable=fps_var, width=4).pack(side=tk.LEFT, padx=5)
+    tk.Button(btn_frame, text="导出动画", command=export, width=10).pack(side=tk.LEFT, padx=5)
+    root.protocol("WM_DELETE_WINDOW", close)
+    tick()
+
+# 保存对话框的文件类型，DDS 按所选类型决定是否块压缩
+SAVE_FILETYPES = [("PNG 文件", "*.png", "png"), ("JPEG 文件", "*.jpg", "jpg"), ("TGA 文件", "*.tga", "tga"),
+                  ("DDS BC1（不透明/1 位透明）", "*.dds", "bc1"), ("DDS BC3（带 Alpha）", "*.dds", "bc3"),
+                  ("DDS 未压缩", "*.dds", "dds"), ("原始 RGBA", "*.rgba", "rgba")]
+
+def save_merged_image(frames, layout, cells, key=None, profile="balanced", representatives=None, on_report=None,
+                      motion=False):
+    filetype = tk.StringVar()
     save_path = filedialog.asksaveasfilename(
         defaultextension=".png",
-        filetypes=[("PNG 文件", "*.png"), ("JPEG 文件", "*.jpg")],
+        filetypes=[(label, pattern) for label, pattern, _ in SAVE_FILETYPES],
+        typevariable=filetype,
         initialfile="merged_image.png"
     )
-    if save_path:
+    if not save_path:
+        return
+    
+    rows, cols = layout
+    width, height = frames.frame_size()
+    
+    fmt = os.path.splitext(save_path)[1].lower().lstrip(".")
+    if fmt == "dds":
+        fmt = next((f for label, pattern, f in SAVE_FILETYPES if label == filetype.get() and pattern == "*.dds"), "bc3")
+    
+    def work(progress):
         try:
-            fmt = "PNG" if save_path.lower().endswith(".png") else "JPEG"
-            new_image.save(save_path, format=fmt, quality=95)
-            messagebox.showinfo("保存成功", f"图片已保存至：\n{save_path}")
+            if fmt in ATLAS_FORMATS:
+                # 逐行解码并写入，不在内存中保留整张原图
+                bands = iter_atlas_bands(frames, layout, cells)
+                if key is not None:
+                    bands = _keyed_bands(bands, key)
+                write_atlas(save_path, bands, (width * cols, height * rows), fmt, profile, progress)
+            else:
+                new_image = compose_atlas(frames, layout, progress, cells)
+                if key is not None:
+                    new_image = key_alpha(new_image, progress=progress, **key)
+                progress.start("编码 JPEG", 1)
+                new_image.convert("RGB").save(save_path, format="JPEG", quality=95)
+                IO_STATS.add(bytes_written=os.path.getsize(save_path))
+                progress.advance(bytes_written=os.path.getsize(save_path))
+            if motion:
+                # JPEG 不适合存矢量，运动矢量图集改存 PNG
+                motion_fmt = fmt if fmt in ATLAS_FORMATS else "png"
+                stem = os.path.splitext(save_path)[0]
+                state["motion"] = write_motion_atlas(frames, layout, f"{stem}_motion.{atlas_extension(motion_fmt)}",
+                                                     cells=cells, fmt=motion_fmt, profile=profile, progress=progress)
+        except TaskCancelled:
+            # 取消时删除写了一半的文件
+            if os.path.exists(save_path):
+                os.remove(save_path)
+            raise
+    
+    def done(_):
+        if frames.crop or representatives or motion:
+            info = atlas_sidecar(frames, layout)
+            if representatives:
+                info.update({"source_frame_count": len(frames), "frame_remap": frame_remap(cells, representatives)})
+            if motion:
+                info["motion_vectors"] = state["motion"]
+            write_sidecar(save_path, info)
+        if on_report:
+            on_report(report, save_path)
+        messagebox.showinfo("保存成功", f"图片已保存至：\n{save_path}")
+    
+    state = {}
+    report = JobReport("保存图像")
+    run_in_background("保存图像", work, done, report)
+
+def find_sequence_folders(source, exclude=None):
+    """查找序列帧文件夹：source 可以是根目录（递归查找）或通配符；exclude（输出目录）及其子目录不计入"""
+    if glob.has_magic(source):
+        candidates = sorted((p for p in glob.glob(source) if os.path.isdir(p)), key=natural_sort_key)
+        if exclude:
+            excluded = os.path.abspath(exclude)
+            candidates = [p for p in candidates
+                          if os.path.commonpath([os.path.abspath(p), excluded]) != excluded]
+    else:
+        candidates = []
+        for dirpath, dirnames, _ in os.walk(source):
+            dirnames.sort(key=natural_sort_key)
+            if exclude:
+                dirnames[:] = [d for d in dirnames
+                               if os.path.abspath(os.path.join(dirpath, d)) != os.path.abspath(exclude)]
+            candidates.append(dirpath)
+    return [p for p in candidates if list_image_files(p)]
+
+def source_root(source):
+    """输出命名的基准目录：根目录本身；通配符时取第一个含通配符的部分之前的目录"""
+    if not glob.has_magic(source):
+        return source
+    parts = []
+    for part in os.path.normpath(source).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or (os.sep if os.path.isabs(source) else ".")
+
+def sequence_name(folder_path, root):
+    """序列的输出名：相对 root 的路径用 _ 连接（如 hero/fire -> hero_fire），root 本身时取文件夹名"""
+    rel = os.path.relpath(os.path.abspath(folder_path), os.path.abspath(root))
+    if rel == "." or rel.startswith(".."):
+        return os.path.basename(os.path.abspath(folder_path))
+    return rel.replace(os.sep, "_")
+
+def duplicate_names(names):
+    """{输出名: [序号…]}，只列出被多个序列共用的名称"""
+    groups = {}
+    for idx, name in enumerate(names):
+        groups.setdefault(name, []).append(idx)
+    return {name: idxs for name, idxs in groups.items() if len(idxs) > 1}
+
+class BuildCache:
+    """增量构建缓存：按文件路径、修改时间、大小和内容哈希识别帧，只重新处理变化的格子
+    
+    目录结构（多个进程可同时使用，写入都先写临时文件再替换）：
+      files/   文件路径 -> 修改时间、大小、内容哈希
+      frames/  解码（裁切、缩放）后的帧数据 .npy
+      atlases/ 上次输出的图集像素 .npy 与每格的帧标识
+      trims/   透明边界扫描结果
+      motion/  上次输出的运动矢量图集的参数、每格的帧标识和 strength
+    超过 max_bytes 时按最近使用时间淘汰最旧的文件。
+    """
+    
+    def __init__(self, cache_dir, max_bytes=4 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        for sub in ("files", "frames", "atlases", "trims", "motion"):
+            os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+    
+    def _path(self, sub, key, ext):
+        return os.path.join(self.cache_dir, sub, hashlib.sha1(key.encode("utf-8")).hexdigest() + ext)
+    
+    def _read_json(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._touch(path)
+        return data
+    
+    def _write_json(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    
+    def content_hash(self, path):
+        """文件内容哈希；修改时间和大小都没变时直接使用记录的哈希，不再读取文件"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        record_path = self._path("files", path, ".json")
+        record = self._read_json(record_path)
+        if record and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            return record["hash"]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self._write_json(record_path, {"path": path, "mtime_ns": stat.st_mtime_ns,
+                                       "size": stat.st_size, "hash": digest.hexdigest()})
+        return digest.hexdigest()
+    
+    def frame_key(self, frames, idx):
+        """帧标识：内容哈希加上裁切、缩放、扩边参数，混合帧再加上下一帧的哈希和权重"""
+        key = f"{self.content_hash(frames.path(idx))}|{frames.crop}|{frames.resize}|{frames.gutter}"
+        blend = frames.blend(idx)
+        if blend:
+            next_file, weight = blend
+            key += f"|{self.content_hash(os.path.join(frames.folder_path, next_file))}|{weight}"
+        return key
+    
+    def frame_array(self, frames, idx, frame_key=None):
+        """取处理后的帧数据，缓存里有就直接读取，否则解码后写入缓存"""
+        frame_key = frame_key or self.frame_key(frames, idx)
+        path = self._path("frames", frame_key, ".npy")
+        try:
+            array = np.load(path)
+            self._touch(path)
+            IO_STATS.add(bytes_read=array.nbytes)
+            return array
+        except (OSError, ValueError):
+            pass
+        array = np.asarray(frames.frame_array(idx))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        return array
+    
+    def trim_box(self, frames, threshold=0):
+        """透明边界扫描结果按全部帧的内容缓存"""
+        key = "|".join(self.frame_key(frames, idx) for idx in range(len(frames))) + f"|{threshold}"
+        path = self._path("trims", key, ".json")
+        box = self._read_json(path)
+        if box is None:
+            box = list(frames.trim_box(threshold))
+            self._write_json(path, box)
+        return tuple(box)
+    
+    def build_atlas(self, frames, option, cells, key, save_path, fmt, profile="balanced", mips=None):
+        """增量生成图集并写出，返回说明文字（mips 见 merge_folder）
+        
+        与上次相比参数和每格的帧都没变且输出文件还在时直接跳过；
+        否则在上次的图集像素（内存映射）上只重新绘制变化的格子，再编码输出。
+        """
+        rows, cols = option["layout"]
+        cell_width, cell_height = option["cell_size"]
+        texture_width, texture_height = option["texture_size"]
+        frame_keys = {idx: self.frame_key(frames, idx) for idx in set(cells) if idx is not None}
+        cell_keys = [frame_keys.get(idx) for idx in cells]
+        params = {"layout": [rows, cols], "cell_size": [cell_width, cell_height],
+                  "texture_size": [texture_width, texture_height], "key": key,
+                  "output": [fmt, profile, mips]}
+        
+        record_path = self._path("atlases", os.path.abspath(save_path), ".json")
+        atlas_path = record_path[:-len(".json")] + ".npy"
+        record = self._read_json(record_path)
+        shape = (texture_height, texture_width, 4)
+        atlas = None
+        if record and json.loads(json.dumps(params)) == record["params"]:
+            try:
+                atlas = np.load(atlas_path, mmap_mode="r+")
+                self._touch(atlas_path)
+            except (OSError, ValueError):
+                atlas = None
+        if atlas is not None and atlas.shape == shape:
+            changed = [idx for idx, (old, new) in enumerate(zip(record["cells"], cell_keys)) if old != new]
+            if not changed and os.path.exists(save_path):
+                return "未变化，已跳过"
+        else:
+            atlas = np.lib.format.open_memmap(atlas_path, mode="w+", dtype=np.uint8, shape=shape)
+            changed = list(range(len(cells)))
+        
+        for idx in changed:
+            y, x = (idx // cols) * cell_height, (idx % cols) * cell_width
+            region = atlas[y:y + cell_height, x:x + cell_width]
+            if cells[idx] is None:
+                region[...] = 0
+                continue
+            region[...] = self.frame_array(frames, cells[idx], cell_keys[idx])
+            if key is not None:
+                _key_band(region, **key)
+        atlas.flush()
+        
+        chain = build_mip_chain(atlas, option["layout"], option["cell_size"], mips) if mips is not None else ()
+        write_atlas(save_path, array_bands(atlas), (texture_width, texture_height), fmt, profile, mips=chain)
+        self._write_json(record_path, {"params": params, "cells": cell_keys})
+        del atlas
+        self.evict()
+        return f"重新绘制 {len(changed)}/{len(cells)} 格"
+    
+    def motion_atlas(self, frames, option, cells, save_path, fmt, profile="balanced", workers=None):
+        """运动矢量图集：布局、输出参数和每格的帧都没变且文件还在时直接返回上次的信息，否则重新计算"""
+        rows, cols = option["layout"]
+        params = {"layout": [rows, cols], "cell_size": list(option["cell_size"]),
+                  "texture_size": list(option["texture_size"]), "output": [fmt, profile]}
+        cell_keys = [None if idx is None else self.frame_key(frames, idx) for idx in cells]
+        record_path = self._path("motion", os.path.abspath(save_path), ".json")
+        record = self._read_json(record_path)
+        if (record and record["params"] == json.loads(json.dumps(params)) and record["cells"] == cell_keys
+                and os.path.exists(save_path)):
+            return record["info"]
+        info = write_motion_atlas(frames, option["layout"], save_path, option["texture_size"], cells, fmt, profile,
+                                  workers)
+        self._write_json(record_path, {"params": params, "cells": cell_keys, "info": info})
+        return info
+    
+    def evict(self):
+        """缓存超过上限时按最近使用时间淘汰最旧的文件"""
+        entries = []
+        for sub in ("files", "frames", "atlases", "trims", "motion"):
+            for entry in os.scandir(os.path.join(self.cache_dir, sub)):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+def merge_folder(folder_path, output_dir, layout_rule="best", key=None, stream=False, fmt="png", trim=False,
+                 max_size=16384, power_of_two=False, allow_downscale=True, paging=False, cache=None,
+                 cache_bytes=4 << 30, profile="balanced", gutter=0, mips=None, dedup=None, resample=None,
+                 blend=False, motion=False, motion_workers=None, name=None, report=None):
+    """无界面合并单个文件夹，返回 (输出路径, 布局, 帧数, 说明)
+    
+    输出文件名为 name（默认取文件夹名）加布局，批量时由 sequence_name 给出不重复的名称；
+    布局由 pick_layout 按 layout_rule 选择，max_size/power_of_two/allow_downscale 传给布局求解器，
+    需要时缩小格子，2 的幂模式下图集右侧和底部补透明边；
+    key 为 key_alpha 的参数，None 表示不抠像；fmt 和 profile 见 write_atlas；
+    stream=True 时逐行解码并直接写入编码器，峰值内存约为一行格子，输出与内存模式逐字节一致；
+    trim=True 时所有帧裁切到 alpha 的并集包围盒。布局、格子尺寸和 UV 信息写入同名 .json；
+    paging=True 且一张放不下时不缩小格子，而是分成多页（见 merge_pages），返回清单路径；
+    cache 为缓存目录时使用 BuildCache 增量构建（分页模式不使用缓存）；
+    gutter 为每格四周复制边缘像素的宽度；mips 不为 None 时生成逐格 mip 链（只用于 DDS 格式，
+    值为总级数，0 表示完整链），需要在内存中保留整张图集，stream 不再生效；
+    dedup 不为 None 时重复帧只放一次（阈值见 FrameStore.find_duplicates），.json 中的 frame_remap
+    给出每个播放帧对应的格子（分页时为清单中的帧序号），重采样时按重采样后的帧排列；
+    resample 为目标帧数时先重采样（"grid" 表示 resample_target），blend=True 时混合相邻帧，
+    只读取和解码用到的帧，.json 中的 resample_map 给出每个重采样帧取自的原始帧序号
+    （resample_blend 为与下一帧混合的权重）；motion=True 时另外生成同布局的运动矢量图集（文件名加 _motion，见
+    write_motion_atlas，分页模式不生成），strength 等写入 .json 的 motion_vectors，motion_workers 为计算用的
+    进程数，使用缓存时格子内容不变就跳过；
+    report 为 JobReport 时按阶段记录统计（由调用方 end）。
+    """
+    report = report or JobReport()
+    report.begin("读取文件头")
+    image_files = list_image_files(folder_path)
+    if not image_files:
+        raise ValueError("文件夹中没有找到图片文件")
+    frames = FrameStore(folder_path, image_files)
+    extra, note = {}, ""
+    if resample is not None:
+        frames = frames.resampled(resample_target(len(frames)) if resample == "grid" else int(resample), blend)
+        source_index = {file: idx for idx, file in enumerate(image_files)}
+        extra = {
+            "source_frame_count": len(image_files),
+            "resampled_frame_count": len(frames),
+            "resample_map": [source_index[file] for file in frames.image_files],
+        }
+        if blend:
+            extra["resample_blend"] = [entry[1] if entry else 0 for entry in frames.blends]
+        note = f"重采样 {len(image_files)}→{len(frames)} 帧"
+    frames.check_sizes()
+    build_cache = BuildCache(cache, cache_bytes) if cache else None
+    if trim:
+        report.begin("扫描透明边界")
+        frames = frames.cropped(build_cache.trim_box(frames) if build_cache else frames.trim_box())
+    if gutter:
+        frames = frames.padded(gutter)
+    if dedup is not None:
+        report.begin("去重")
+        representatives = frames.find_duplicates(dedup)
+        unique = sorted(set(representatives))
+        position = {idx: pos for pos, idx in enumerate(unique)}
+        if resample is None:
+            extra["source_frame_count"] = len(frames)
+        extra["frame_remap"] = [position[rep] for rep in representatives]
+        note = " ".join(filter(None, [note, f"去重 {len(frames)}→{len(unique)} 帧"]))
+        frames = frames.subset(unique)
+    name = name or os.path.basename(os.path.normpath(folder_path))
+    if paging and layout_rule in ("best", "square"):
+        pages = plan_pages(len(frames), frames.frame_size(), max_size, power_of_two)
+        if pages is not None:
+            report.begin("分页拼合并编码")
+            save_path, option = merge_pages(frames, pages, output_dir, name, key, fmt, profile, mips, extra)
+            if motion:
+                note = " ".join(filter(None, [note, "分页模式未生成运动矢量"]))
+            return save_path, option["layout"], len(image_files), " ".join(filter(None, [f"{pages[0]} 页", note]))
+    
+    option = pick_layout(len(frames), frames.frame_size(), layout_rule, max_size=max_size,
+                         power_of_two=power_of_two, allow_downscale=allow_downscale)
+    if option["scale"] < 1:
+        frames = frames.resized(option["cell_size"])
+    layout = option["layout"]
+    rows, cols = layout
+    save_path = os.path.join(output_dir, f"{name}_{rows}x{cols}.{atlas_extension(fmt)}")
+    
+    if build_cache:
+        report.begin("增量拼合并编码")
+        cache_note = build_cache.build_atlas(frames, option, default_cells(len(frames), layout), key, save_path,
+                                             fmt, profile, mips)
+        if motion:
+            report.begin("计算运动矢量")
+            extra["motion_vectors"] = build_cache.motion_atlas(frames, option, default_cells(len(frames), layout),
+                                                               motion_path(save_path), fmt, profile, motion_workers)
+        write_sidecar(save_path, {**atlas_sidecar(frames, layout, option["texture_size"]), **extra})
+        return save_path, layout, len(image_files), " ".join(filter(None, [cache_note, note]))
+    
+    if stream:
+        report.begin("流式拼合并编码")
+        bands = iter_atlas_bands(frames, layout)
+        if key is not None:
+            bands = _keyed_bands(bands, key)
+    else:
+        report.begin("解码并拼合")
+        atlas = compose_atlas(frames, layout)
+        if key is not None:
+            report.begin("抠像")
+            atlas = key_alpha(atlas, **key)
+        bands = image_bands(atlas)
+    
+    if option["texture_size"] != option["used_size"]:
+        bands = pad_bands(bands, option["used_size"], option["texture_size"])
+    if mips is not None:
+        report.begin("生成 mip")
+    bands, chain = with_mips(bands, option, mips)
+    report.begin("编码写出")
+    write_atlas(save_path, bands, option["texture_size"], fmt, profile, mips=chain)
+    if motion:
+        report.begin("计算运动矢量")
+        extra["motion_vectors"] = write_motion_atlas(frames, layout, motion_path(save_path), option["texture_size"],
+                                                     fmt=fmt, profile=profile, workers=motion_workers)
+    write_sidecar(save_path, {**atlas_sidecar(frames, layout, option["texture_size"]), **extra})
+    return save_path, layout, len(image_files), note
+
+def plan_pages(num, frame_size, max_size=16384, power_of_two=False):
+    """多页规划：一页放不下全部帧时，返回 (页数, 每页帧数, 每页布局方案)，一页放得下时返回 None
+    
+    每页容量按不缩小格子时 max_size 内最多能放的格子数计算，再把帧平均分到各页，所有页使用同一布局。
+    """
+    width, height = frame_size
+    if not solve_layout(1, frame_size, max_size, power_of_two, allow_downscale=False, limit=1):
+        suffix = "（补齐到 2 的幂后）" if power_of_two else ""
+        raise ValueError(f"单帧 {width}x{height}{suffix}已超过最大纹理尺寸 {max_size}")
+    if solve_layout(num, frame_size, max_size, power_of_two, allow_downscale=False, limit=1):
+        return None
+    capacity = (max_size // width) * (max_size // height)
+    page_count = math.ceil(num / capacity)
+    while True:
+        per_page = math.ceil(num / page_count)
+        options = solve_layout(per_page, frame_size, max_size, power_of_two, allow_downscale=False, limit=1)
+        if options:
+            return page_count, per_page, options[0]
+        page_count += 1  # 2 的幂补边后放不下时再多分一页
+
+def merge_pages(frames, pages, output_dir, name, key=None, fmt="png", profile="balanced", mips=None, extra=None):
+    """把帧分到多页图集，各页在线程池中并行拼合和编码，返回 (清单路径, 每页布局方案)
+    
+    清单与图集同名（不带页号），记录每一帧所在的页、格子和行列，extra 中的字段一并写入。
+    """
+    page_count, per_page, option = pages
+    rows, cols = option["layout"]
+    base = os.path.join(output_dir, f"{name}_{rows}x{cols}")
+    
+    def write_page(page):
+        start = page * per_page
+        count = min(per_page, len(frames) - start)
+        cells = [start + idx for idx in range(count)] + [None] * (rows * cols - count)
+        bands = iter_atlas_bands(frames, option["layout"], cells)
+        if key is not None:
+            bands = _keyed_bands(bands, key)
+        if option["texture_size"] != option["used_size"]:
+            bands = pad_bands(bands, option["used_size"], option["texture_size"])
+        bands, chain = with_mips(bands, option, mips)
+        save_path = f"{base}_p{page}.{atlas_extension(fmt)}"
+        write_atlas(save_path, bands, option["texture_size"], fmt, profile, mips=chain)
+        return save_path
+    
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        page_paths = list(pool.map(write_page, range(page_count)))
+    
+    manifest = atlas_sidecar(frames, option["layout"], option["texture_size"])
+    manifest["pages"] = [os.path.basename(p) for p in page_paths]
+    manifest["frames"] = [
+        {"frame": idx, "file": frames.image_files[idx], "page": idx // per_page, "cell": idx % per_page,
+         "row": idx % per_page // cols, "col": idx % per_page % cols}
+        for idx in range(len(frames))
+    ]
+    manifest.update(extra or {})
+    manifest_path = f"{base}.json"
+    write_sidecar(manifest_path, manifest)
+    return manifest_path, option
+
+def with_mips(bands, option, mips=None):
+    """需要 mip 链时把逐段的图集收集成整张，返回 (第 0 级的行段, 其余各级)；不需要时原样返回"""
+    if mips is None:
+        return bands, ()
+    atlas = np.concatenate(list(bands))
+    return array_bands(atlas), build_mip_chain(atlas, option["layout"], option["cell_size"], mips)
+
+def pad_bands(bands, used_size, texture_size, band_rows=256):
+    """把图集补齐到纹理尺寸：每段右侧补透明列，最后补透明行"""
+    used_width, used_height = used_size
+    texture_width, texture_height = texture_size
+    for band in bands:
+        if texture_width > used_width:
+            padded = np.zeros((band.shape[0], texture_width, 4), dtype=np.uint8)
+            padded[:, :used_width] = band
+            band = padded
+        yield band
+    for top in range(used_height, texture_height, band_rows):
+        yield np.zeros((min(band_rows, texture_height - top), texture_width, 4), dtype=np.uint8)
+
+def atlas_sidecar(frames, layout, texture_size=None):
+    """图集的附加信息：布局、格子和纹理尺寸
+    
+    裁切过时附带 UV 偏移和缩放，在 UE 中用它们把裁切后的格子还原到原始帧中的位置。
+    """
+    rows, cols = layout
+    cell_width, cell_height = frames.frame_size()
+    used_size = [cell_width * cols, cell_height * rows]
+    texture_size = list(texture_size or used_size)
+    info = {
+        "layout": {"rows": rows, "cols": cols},
+        "atlas_size": texture_size,
+        "used_size": used_size,
+        "cell_size": [cell_width, cell_height],
+        "cell_uv_size": [cell_width / texture_size[0], cell_height / texture_size[1]],
+    }
+    if frames.gutter:
+        # 扩边时格子内的有效内容相对格子左上角的 UV 偏移和大小
+        g = frames.gutter
+        info.update({
+            "gutter": g,
+            "content_uv_offset": [g / texture_size[0], g / texture_size[1]],
+            "content_uv_size": [(cell_width - 2 * g) / texture_size[0], (cell_height - 2 * g) / texture_size[1]],
+        })
+    if frames.crop:
+        source_width, source_height = frames.source_size()
+        left, top, right, bottom = frames.crop
+        info.update({
+            "source_size": [source_width, source_height],
+            "crop_offset": [left, top],
+            "uv_offset": [left / source_width, top / source_height],
+            "uv_scale": [(right - left) / source_width, (bottom - top) / source_height],
+        })
+    return info
+
+def write_sidecar(save_path, info):
+    """把图集的附加信息写入与图集同名的 .json 文件"""
+    with open(os.path.splitext(save_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+
+# 运动矢量图集：R/G = 0.5 + 以格子 UV 为单位的位移 / (2 × strength)，V 向下，B 为 0；第 k 格为第 k 帧到下一帧的运动
+MOTION_BLOCK = 8
+
+def block_motion(prev, nxt, block=MOTION_BLOCK, radius=4):
+    """金字塔块匹配：返回 prev 到 nxt 每个 block×block 块的运动矢量 (块行, 块列, 2)，依次为 x、y，单位为像素
+    
+    逐级减半到块数很少为止，最粗一级在 ±radius 内全搜索，之后每级把矢量放大一倍再在 ±1 内细化，
+    最后一级用相邻代价抛物线拟合得到亚像素位移。每级都同时试零位移；所有块的同一候选位移一次向量化计算 SAD。
+    """
+    levels = [(prev, nxt)]
+    while min(levels[-1][0].shape) >= block * 4:
+        levels.append(tuple(_half_size(plane) for plane in levels[-1]))
+    flow = None
+    for level, (p, n) in enumerate(reversed(levels)):
+        h, w = p.shape
+        rows, cols = -(-h // block), -(-w // block)
+        if flow is None:
+            flow = np.zeros((rows, cols, 2), dtype=np.int32)
+        else:
+            flow = np.repeat(np.repeat(flow * 2, 2, axis=0), 2, axis=1)[:rows, :cols]
+            flow = np.pad(flow, ((0, rows - flow.shape[0]), (0, cols - flow.shape[1]), (0, 0)), mode="edge")
+        ys = np.minimum(np.arange(rows * block), h - 1).reshape(rows, 1, block, 1)
+        xs = np.minimum(np.arange(cols * block), w - 1).reshape(1, cols, 1, block)
+        ref = p[ys, xs]
+        
+        def sad(vx, vy):
+            ty = np.clip(ys + vy[:, :, None, None], 0, h - 1)
+            tx = np.clip(xs + vx[:, :, None, None], 0, w - 1)
+            return np.abs(n[ty, tx] - ref).sum(axis=(2, 3))
+        
+        r = radius if level == 0 else 1
+        steps = sorted(((dx, dy) for dy in range(-r, r + 1) for dx in range(-r, r + 1)),
+                       key=lambda d: abs(d[0]) + abs(d[1]))
+        # 先以零位移为基准，平坦或全透明的块代价相同，保持静止而不继承粗一级的矢量
+        base, flow = flow, np.zeros_like(flow)
+        best = sad(flow[..., 0], flow[..., 1])
+        for dx, dy in steps:  # 从小位移开始试，代价相同时保留较小的位移
+            cost = sad(base[..., 0] + dx, base[..., 1] + dy)
+            better = cost < best
+            best = np.where(better, cost, best)
+            flow[better] = base[better] + (dx, dy)
+    
+    # 亚像素：在最优位置两侧取代价做抛物线拟合
+    result = flow.astype(np.float32)
+    one = np.ones_like(flow[..., 0])
+    for axis in range(2):
+        step = np.zeros_like(flow)
+        step[..., axis] = one
+        minus = sad(*(flow - step).transpose(2, 0, 1))
+        plus = sad(*(flow + step).transpose(2, 0, 1))
+        curve = minus + plus - 2 * best
+        with np.errstate(divide="ignore", invalid="ignore"):
+            offset = np.where(curve > 0, (minus - plus) / (2 * curve), 0)
+        result[..., axis] += np.clip(offset, -0.5, 0.5)
+    return result
+
+def _half_size(plane):
+    """2×2 平均缩小一半（奇数边长舍去最后一行/列）"""
+    h, w = plane.shape[0] // 2 * 2, plane.shape[1] // 2 * 2
+    return plane[:h, :w].reshape(h // 2, 2, w // 2, 2).mean(axis=(1, 3), dtype=np.float32)
+
+def motion_plane(array):
+    """运动估计用的平面：亮度按 alpha 预乘，透明区域的杂色不参与匹配"""
+    rgb = array[..., :3].astype(np.float32)
+    luma = rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+    return luma * (array[..., 3] / np.float32(255))
+
+def _motion_worker(frames, pairs):
+    """在子进程中计算一段相邻帧对的块运动矢量，连续的帧只解码一次"""
+    planes = {}
+    results = []
+    for first, second in pairs:
+        for idx in (first, second):
+            if idx not in planes:
+                planes[idx] = motion_plane(frames.frame_array(idx))
+        results.append(block_motion(planes[first], planes[second]))
+        planes = {idx: plane for idx, plane in planes.items() if idx == second}
+    return results
+
+def compute_motion(frames, sequence, workers=None, progress=None):
+    """按播放顺序 sequence（帧序号列表）计算每帧到下一帧（最后一帧回到第一帧）的块运动矢量
+    
+    帧对按连续的段分给进程池，每段在子进程中解码并匹配，充分利用所有核心；workers=1 时在当前进程中
+    逐段计算（已经在批量进程池中时使用，避免进程数相乘）。返回与 sequence 等长的列表。
+    """
+    pairs = list(zip(sequence, sequence[1:] + sequence[:1]))
+    if progress:
+        progress.start("计算运动矢量", len(pairs))
+    # 子进程只需要取帧参数，不带已解码的缓存
+    store = FrameStore(frames.folder_path, frames.image_files, crop=frames.crop, resize=frames.resize,
+                       gutter=frames.gutter, blends=frames.blends)
+    workers = workers or os.cpu_count() or 1
+    chunk = max(1, math.ceil(len(pairs) / (workers * 4)))
+    results = [None] * len(pairs)
+    if workers == 1:
+        for start in range(0, len(pairs), chunk):
+            vectors = _motion_worker(store, pairs[start:start + chunk])
+            results[start:start + len(vectors)] = vectors
+            if progress:
+                progress.advance(len(vectors))
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_motion_worker, store, pairs[start:start + chunk]): start
+                   for start in range(0, len(pairs), chunk)}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                start = futures[future]
+                vectors = future.result()
+                results[start:start + len(vectors)] = vectors
+                if progress:
+                    progress.advance(len(vectors))
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+def motion_strength(vectors, cell_size):
+    """能表示全部运动的最小 strength（格子 UV 单位，向上取到 1/1000）"""
+    width, height = cell_size
+    peak = max((float(np.abs(v / (width, height)).max()) for v in vectors), default=0.0)
+    return max(math.ceil(peak * 1000) / 1000, 0.001)
+
+def iter_motion_bands(vectors, layout, cell_size, strength, cells=None):
+    """逐行生成运动矢量图集：块矢量双线性插值到每个像素，按 strength 编码到 R/G，空格子为静止"""
+    rows, cols = layout
+    width, height = cell_size
+    cells = cells if cells is not None else list(range(len(vectors)))
+    scale = np.array([0.5 / (width * strength), 0.5 / (height * strength)], dtype=np.float32)
+    for row in range(rows):
+        band = np.zeros((height, width * cols, 4), dtype=np.uint8)
+        band[..., :2] = 128
+        band[..., 3] = 255
+        for col in range(cols):
+            pos = row * cols + col
+            if pos >= len(cells) or cells[pos] is None:
+                continue
+            block_vectors = vectors[cells[pos]]
+            block_rows, block_cols = block_vectors.shape[:2]
+            for axis in range(2):
+                field = Image.fromarray(block_vectors[..., axis] * scale[axis], "F")
+                field = np.asarray(field.resize((block_cols * MOTION_BLOCK, block_rows * MOTION_BLOCK),
+                                                Image.BILINEAR))[:height, :width]
+                band[:, col * width:(col + 1) * width, axis] = np.clip(np.rint((field + 0.5) * 255), 0, 255)
+        yield band
+
+def write_motion_atlas(frames, layout, save_path, texture_size=None, cells=None, fmt="png", profile="balanced",
+                       workers=None, progress=None):
+    """为 frames 按 cells（格子 -> 帧序号，默认顺序排列）的顺序生成同布局的运动矢量图集，返回写入 .json 的信息"""
+    rows, cols = layout
+    cells = cells if cells is not None else default_cells(len(frames), layout)
+    sequence = [idx for idx in cells if idx is not None]
+    vectors = compute_motion(frames, sequence, workers, progress)
+    strength = motion_strength(vectors, frames.frame_size())
+    position = {pos: seq for seq, pos in enumerate(pos for pos, idx in enumerate(cells) if idx is not None)}
+    cell_vectors = [position.get(pos) for pos in range(len(cells))]
+    bands = iter_motion_bands(vectors, layout, frames.frame_size(), strength, cell_vectors)
+    width, height = frames.frame_size()
+    used_size = (width * cols, height * rows)
+    texture_size = tuple(texture_size or used_size)
+    if texture_size != used_size:
+        bands = pad_bands(bands, used_size, texture_size)
+    if progress:
+        progress.start("编码运动矢量", 1)
+    write_atlas(save_path, bands, texture_size, fmt, profile)
+    return {"file": os.path.basename(save_path), "strength": strength, "block_size": MOTION_BLOCK}
+
+def motion_path(save_path):
+    """运动矢量图集的路径：图集文件名加 _motion"""
+    stem, ext = os.path.splitext(save_path)
+    return f"{stem}_motion{ext}"
+
+# 通道打包：每个通道可取帧的亮度或某一个通道
+PACK_SOURCES = ("L", "R", "G", "B", "A")
+PACK_CHANNELS = "RGBA"
+
+def pack_channels(folders, output_dir, name=None, sources="L", layout_rule="best", max_size=16384,
+                  power_of_two=False, allow_downscale=True, fmt="png", profile="balanced", resample=None,
+                  report=None):
+    """把最多四个灰度序列分别写入一张图集的 R/G/B/A 通道，返回 (输出路径, 布局, 帧数)
+    
+    folders 中的 None 表示该通道留空（RGB 填 0，A 填 255）；sources 为每个通道取帧的哪个分量
+    （单个字母表示全部相同），见 FrameStore.plane。各序列帧数和帧尺寸必须一致，resample 可先把它们
+    重采样到相同帧数。逐行拼合：一行格子的所有通道在线程池中并行解码成单通道平面，直接赋值到行段的
+    对应通道，不生成中间的 RGBA 帧。
+    """
+    if not 1 <= len(folders) <= 4 or all(folder is None for folder in folders):
+        raise ValueError("需要 1~4 个序列文件夹")
+    sources = list(sources) * len(folders) if len(sources) == 1 else list(sources)
+    if len(sources) != len(folders) or any(s not in PACK_SOURCES for s in sources):
+        raise ValueError(f"每个通道的来源必须是 {'/'.join(PACK_SOURCES)} 之一")
+    report = report or JobReport()
+    report.begin("读取文件头")
+    stores = {}
+    for channel, folder_path in enumerate(folders):
+        if folder_path is None:
+            continue
+        image_files = list_image_files(folder_path)
+        if not image_files:
+            raise ValueError(f"{folder_path} 中没有找到图片文件")
+        frames = FrameStore(folder_path, image_files)
+        if resample is not None:
+            frames = frames.resampled(resample_target(len(frames)) if resample == "grid" else int(resample))
+        frames.check_sizes()
+        stores[channel] = frames
+    first = next(iter(stores.values()))
+    count, frame_size = len(first), first.frame_size()
+    for channel, frames in stores.items():
+        if len(frames) != count:
+            raise ValueError(f"{PACK_CHANNELS[channel]} 通道有 {len(frames)} 帧，与其他通道的 {count} 帧不一致，"
+                             f"可以用 --frames 重采样到相同帧数")
+        if frames.frame_size() != frame_size:
+            raise ValueError(f"{PACK_CHANNELS[channel]} 通道的帧尺寸 {frames.frame_size()} 与其他通道 {frame_size} 不一致")
+    
+    option = pick_layout(count, frame_size, layout_rule, max_size=max_size,
+                         power_of_two=power_of_two, allow_downscale=allow_downscale)
+    if option["scale"] < 1:
+        stores = {channel: frames.resized(option["cell_size"]) for channel, frames in stores.items()}
+    layout = option["layout"]
+    rows, cols = layout
+    name = name or "_".join(os.path.basename(os.path.normpath(f)) if f else "none" for f in folders)
+    save_path = os.path.join(output_dir, f"{name}_{rows}x{cols}.{atlas_extension(fmt)}")
+    
+    report.begin("解码并打包")
+    bands = iter_packed_bands(stores, sources, layout, option["cell_size"])
+    if option["texture_size"] != option["used_size"]:
+        bands = pad_bands(bands, option["used_size"], option["texture_size"])
+    write_atlas(save_path, bands, option["texture_size"], fmt, profile)
+    info = atlas_sidecar(next(iter(stores.values())), layout, option["texture_size"])  # 缩小后的格子尺寸
+    info["channels"] = {PACK_CHANNELS[channel]: {"folder": folder_path, "source": sources[channel]}
+                        for channel, folder_path in enumerate(folders) if folder_path is not None}
+    write_sidecar(save_path, info)
+    report.end()
+    return save_path, layout, count
+
+def iter_packed_bands(stores, sources, layout, cell_size):
+    """逐行生成通道打包的图集行段：stores 为 {通道序号: FrameStore}，空通道 RGB 为 0、A 为 255"""
+    rows, cols = layout
+    width, height = cell_size
+    count = len(next(iter(stores.values())))
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        for row in range(rows):
+            band = np.zeros((height, width * cols, 4), dtype=np.uint8)
+            if 3 not in stores:
+                band[..., 3] = 255
+            jobs = [(channel, col, pool.submit(frames.plane, row * cols + col, sources[channel]))
+                    for channel, frames in stores.items() for col in range(cols) if row * cols + col < count]
+            for channel, col, job in jobs:
+                band[:, col * width:(col + 1) * width, channel] = job.result()
+            yield band
+
+def _keyed_bands(bands, key):
+    """流式模式下逐段抠像"""
+    for band in bands:
+        _key_band(band, **key)
+        yield band
+
+def _batch_worker(folder_path, output_dir, options):
+    """进程池任务：捕获异常，单个文件夹失败不影响其他文件夹
+    
+    结果中附带分阶段统计；options 中 write_report=True 时统计另存为与图集同名的 .report.json。
+    """
+    options = dict(options)
+    write_report = options.pop("write_report", False)
+    report = JobReport(folder_path)
+    start = time.perf_counter()
+    try:
+        save_path, layout, count, note = merge_folder(folder_path, output_dir, report=report, **options)
+        report.end()
+        result = {"folder": folder_path, "ok": True, "output": save_path, "layout": layout,
+                  "frames": count, "note": note, "seconds": time.perf_counter() - start,
+                  "report": report.to_dict()}
+        if write_report:
+            with open(os.path.splitext(save_path)[0] + ".report.json", "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+        return result
+    except Exception as e:
+        report.end()
+        return {"folder": folder_path, "ok": False, "error": f"{type(e).__name__}: {e}",
+                "seconds": time.perf_counter() - start, "report": report.to_dict()}
+
+def batch_merge(source, output_dir=None, workers=None, log=print, **options):
+    """批量合并：用进程池在所有核心上并行处理每个序列文件夹，返回每个文件夹的结果
+    
+    options 原样传给 merge_folder（layout_rule、key 等）。
+    """
+    if output_dir is None:
+        output_dir = "_merged" if glob.has_magic(source) else os.path.join(source, "_merged")
+    os.makedirs(output_dir, exist_ok=True)
+    folders = find_sequence_folders(source, exclude=output_dir)
+    if not folders:
+        log(f"没有找到包含图片的文件夹：{source}")
+        return []
+    
+    results = []
+    start = time.perf_counter()
+    root = source_root(source)
+    names = [sequence_name(folder, root) for folder in folders]
+    # 输出名相同的文件夹会互相覆盖，提交任务前直接判为失败
+    rejected = set()
+    for name, idxs in duplicate_names(names).items():
+        for idx in idxs:
+            rejected.add(idx)
+            result = {"folder": folders[idx], "ok": False, "seconds": 0.0,
+                      "error": f"输出名 {name} 与 {len(idxs) - 1} 个其他文件夹重复"}
+            results.append(result)
+            log_result(result, log)
+    # 运动矢量的进程数按同时处理的文件夹数分摊核心，避免每个任务再各开满核心的进程池
+    pool_size = min(workers or os.cpu_count() or 1, max(1, len(folders) - len(rejected)))
+    motion_workers = max(1, (os.cpu_count() or 1) // pool_size)
+    jobs = [(folders[idx], {**options, "name": names[idx], "motion_workers": motion_workers})
+            for idx in range(len(folders)) if idx not in rejected]
+    
+    crashed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_batch_worker, folder, output_dir, job_options): (folder, job_options)
+                   for folder, job_options in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                crashed.append(futures[future])  # 某个进程异常退出，池中其他任务也一起失败
+                continue
+            results.append(result)
+            log_result(result, log)
+    # 进程池损坏时逐个在新进程中重试，找出真正导致崩溃的文件夹
+    for folder, job_options in crashed:
+        retry_start = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                result = pool.submit(_batch_worker, folder, output_dir, job_options).result()
+            except concurrent.futures.process.BrokenProcessPool:
+                result = {"folder": folder, "ok": False, "error": "处理进程异常退出（内存不足或崩溃）",
+                          "seconds": time.perf_counter() - retry_start}
+        results.append(result)
+        log_result(result, log)
+    
+    failed = sum(not r["ok"] for r in results)
+    log(f"共 {len(results)} 个文件夹，成功 {len(results) - failed}，失败 {failed}，"
+        f"总耗时 {time.perf_counter() - start:.2f}s")
+    return results
+
+def generate_sequence(folder_path, count, size, alpha_density=0.5, seed=0):
+    """生成合成序列帧：白底上移动的带噪声圆斑，alpha_density 为不透明像素的大致比例
+    
+    圆斑内部完全不透明，外侧有宽度为半径 1/8 的渐变边缘；半径按第一帧的距离分布取分位数，
+    圆斑超出画面时也能得到接近 alpha_density 的不透明比例。
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    def distance_to_center(idx):
+        angle = 2 * math.pi * idx / max(count, 1)
+        cx, cy = width / 2 + width / 4 * math.cos(angle), height / 2 + height / 4 * math.sin(angle)
+        return np.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+    
+    radius = float(np.quantile(distance_to_center(0), min(max(alpha_density, 0), 1)))
+    edge = max(1.0, radius / 8)
+    for idx in range(count):
+        distance = distance_to_center(idx)
+        alpha = np.clip((radius + edge - distance) * (255 / edge), 0, 255).astype(np.uint8)
+        frame = np.empty((height, width, 4), dtype=np.uint8)
+        frame[..., :3] = rng.integers(0, 200, (height, width, 3), dtype=np.uint8)
+        frame[alpha == 0, :3] = 255  # 透明区域为纯白，供白转透明测试
+        frame[..., 3] = alpha
+        Image.fromarray(frame).save(os.path.join(folder_path, f"frame_{idx:04d}.png"), compress_level=1)
+
+def bench_case(folder_path, output_dir, repeat=3):
+    """对一个序列文件夹依次计时各阶段（取 repeat 次中最快的一次），不需要界面
+    
+    阶段：decode（并行解码全部帧，不保留）、merge（与合并时相同，逐帧解码并复制进图集）、key（白转透明）、preview（从文件生成预览缩略图，与界面一样
+    解码时就缩小，不使用 decode 阶段的缓存）、
+    save_png/save_png_stream/save_bc1（保存）。每个阶段后记录进程峰值内存。
+    """
+    image_files = list_image_files(folder_path)
+    frame_size = FrameStore(folder_path, image_files).check_sizes()
+    layout = pick_layout(len(image_files), frame_size)["layout"]
+    results = {}
+    
+    def timed(name, func):
+        best = None
+        value = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            value = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {"seconds": round(best, 6), "peak_rss_mb": peak_rss_mb()}
+        return value
+    
+    def decode():
+        # 与拼合时一样逐帧解码成数组，只计时不保留
+        frames = FrameStore(folder_path, image_files)
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for _ in pool.map(frames.frame_array, range(len(frames))):
+                pass
+    
+    timed("decode", decode)
+    atlas = timed("merge", lambda: compose_atlas(FrameStore(folder_path, image_files), layout))
+    timed("key", lambda: white_to_transparent(atlas))
+    thumb_size = preview_cell_size(frame_size, layout)
+    timed("preview", lambda: FrameStore(folder_path, image_files).preload_thumbnails(thumb_size))
+    save_path = os.path.join(output_dir, "bench")
+    timed("save_png", lambda: write_atlas(save_path + ".png", image_bands(atlas), atlas.size))
+    timed("save_png_stream", lambda: write_atlas(
+        save_path + ".png", iter_atlas_bands(FrameStore(folder_path, image_files), layout), atlas.size))
+    timed("save_bc1", lambda: write_atlas(save_path + ".dds", image_bands(atlas), atlas.size, "bc1"))
+    return {"layout": list(layout), "atlas_size": list(atlas.size), "stages": results}
+
+def _bench_worker(spec, work_dir, repeat):
+    """子进程中生成序列并计时，使每个用例的峰值内存互不影响"""
+    width, height, count, alpha = spec
+    folder_path = os.path.join(work_dir, f"{width}x{height}_{count}_{alpha}")
+    generate_sequence(folder_path, count, (width, height), alpha)
+    result = {"size": [width, height], "count": count, "alpha_density": alpha}
+    result.update(bench_case(folder_path, work_dir, repeat))
+    return result
+
+def run_benchmarks(sizes, counts, alphas, repeat=3, output=None, compare=None, log=print):
+    """在临时目录中生成各种尺寸、帧数、透明度的合成序列并逐个计时，结果写入 JSON
+    
+    每个用例在单独的子进程中运行；compare 为之前的结果文件时按用例输出各阶段耗时的比值。
+    """
+    import platform
+    import tempfile
+    try:
+        with open(os.path.abspath(__file__), "rb") as f:
+            script_sha1 = hashlib.sha1(f.read()).hexdigest()  # 用于区分被测的版本
+    except OSError:
+        script_sha1 = None  # 打包后的程序没有源文件
+    report = {
+        "script_sha1": script_sha1,
+        "python": platform.python_version(), "numpy": np.__version__, "pillow": Image.__version__,
+        "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "cases": [],
+    }
+    specs = [(w, h, c, a) for w, h in sizes for c in counts for a in alphas]
+    with tempfile.TemporaryDirectory(prefix="atlas_bench_") as work_dir:
+        for spec in specs:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                case = pool.submit(_bench_worker, spec, work_dir, repeat).result()
+            report["cases"].append(case)
+            stages = "  ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in case["stages"].items())
+            peak = max((stage["peak_rss_mb"] or 0) for stage in case["stages"].values())
+            log(f"{spec[0]}x{spec[1]} x{spec[2]} alpha={spec[3]}: {stages}  峰值内存 {peak:.0f}MB")
+    
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        log(f"结果已写入 {output}")
+    if compare:
+        with open(compare, encoding="utf-8") as f:
+            baseline = {(tuple(c["size"]), c["count"], c["alpha_density"]): c for c in json.load(f)["cases"]}
+        for case in report["cases"]:
+            old = baseline.get((tuple(case["size"]), case["count"], case["alpha_density"]))
+            if old is None:
+                continue
+            ratios = "  ".join(f"{name} x{stage['seconds'] / old['stages'][name]['seconds']:.2f}"
+                               for name, stage in case["stages"].items()
+                               if old["stages"].get(name, {}).get("seconds"))
+            log(f"对比 {case['size'][0]}x{case['size'][1]} x{case['count']} alpha={case['alpha_density']}: {ratios}")
+    return report
+
+def log_result(result, log=print):
+    """输出单个文件夹的合并结果"""
+    if result["ok"]:
+        rows, cols = result["layout"]
+        note = f"  {result['note']}" if result["note"] else ""
+        log(f"[完成] {result['folder']}  {result['frames']}帧  {rows}x{cols}  "
+            f"{result['seconds']:.2f}s{note} -> {result['output']}")
+    else:
+        log(f"[失败] {result['folder']}  {result['seconds']:.2f}s  {result['error']}")
+
+def folder_snapshot(folder_path):
+    """文件夹中图片的 {文件名: (大小, 修改时间)}，用于判断是否还在写入"""
+    snapshot = {}
+    for name in list_image_files(folder_path):
+        try:
+            stat = os.stat(os.path.join(folder_path, name))
+        except OSError:
+            continue  # 扫描时被删除或改名
+        snapshot[name] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+def watch_folders(source, output_dir=None, interval=1.0, settle=5.0, expect=None, log=print, stop=None,
+                  **options):
+    """持续轮询 source 下的序列文件夹，序列写完后自动合并，文件再变化时重新合并
+    
+    连续两次扫描大小和修改时间都没变的帧视为已写完，立即在线程池中解码进 BuildCache（未指定 cache 时
+    使用输出目录下的 .cache），合并时只需读取缓存；文件夹静默 settle 秒（或达到 expect 帧且都已写完）后合并。
+    预解码按合并时同样的扩边和缩小处理帧（见 predecode_store），trim、重采样等要等序列完整才能确定的处理
+    不预解码。
+    stop 为 threading.Event 时可以从其他线程停止，否则一直运行到 Ctrl+C。options 原样传给 merge_folder。
+    """
+    if output_dir is None:
+        output_dir = "_merged" if glob.has_magic(source) else os.path.join(source, "_merged")
+    os.makedirs(output_dir, exist_ok=True)
+    if not options.get("cache"):
+        options["cache"] = os.path.join(output_dir, ".cache")
+    build_cache = BuildCache(options["cache"], options.get("cache_bytes", 4 << 30))
+    states = {}
+    log(f"开始监视 {source}：每 {interval}s 扫描一次，静默 {settle}s 后合并，按 Ctrl+C 停止")
+    
+    def predecode(folder_path, names, count):
+        frames = predecode_store(folder_path, names, count, options)
+        if frames is None:
+            return names
+        def decode(idx):
+            try:
+                build_cache.frame_array(frames, idx)
+                return True
+            except Exception:
+                return False  # 文件还不完整，下次扫描再试
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            return [name for name, ok in zip(names, pool.map(decode, range(len(names)))) if ok]
+    
+    root = source_root(source)
+    while not (stop and stop.is_set()):
+        now = time.monotonic()
+        folders = find_sequence_folders(source, exclude=output_dir)
+        names = [sequence_name(folder_path, root) for folder_path in folders]
+        duplicated = {folders[idx] for idxs in duplicate_names(names).values() for idx in idxs}
+        for folder_path, name in zip(folders, names):
+            state = states.setdefault(folder_path, {"snapshot": {}, "changed_at": now, "decoded": set(),
+                                                    "merged": None})
+            snapshot = folder_snapshot(folder_path)
+            previous = state["snapshot"]
+            stable = [name for name, stat in snapshot.items() if previous.get(name) == stat]
+            if snapshot != previous:
+                state["snapshot"], state["changed_at"] = snapshot, now
+            
+            new = [name for name in stable if (name, snapshot[name]) not in state["decoded"]]
+            if new:
+                count = max(len(snapshot), expect or 0)
+                state["decoded"].update((name, snapshot[name]) for name in predecode(folder_path, new, count))
+            
+            all_stable = len(stable) == len(snapshot)
+            complete = all_stable and (now - state["changed_at"] >= settle
+                                       or (expect is not None and len(snapshot) >= expect))
+            if complete and snapshot != state["merged"]:
+                state["merged"] = snapshot  # 失败时也不重试，直到文件再次变化
+                if folder_path in duplicated:
+                    log_result({"folder": folder_path, "ok": False, "seconds": 0.0,
+                                "error": f"输出名 {name} 与其他文件夹重复"}, log)
+                    continue
+                log_result(_batch_worker(folder_path, output_dir, {**options, "name": name}), log)
+        if stop:
+            stop.wait(interval)
+        else:
+            time.sleep(interval)
+
+def predecode_store(folder_path, names, count, options):
+    """监视模式预解码用的仓库：按 merge_folder 的顺序扩边，并按 count 帧的布局缩小格子，
+    使缓存的帧标识与合并时一致；需要完整序列才能确定的处理（trim、重采样、去重后缩小）返回 None
+    """
+    if options.get("trim") or options.get("resample") is not None:
+        return None
+    frames = FrameStore(folder_path, names)
+    if options.get("gutter"):
+        frames = frames.padded(options["gutter"])
+    try:
+        option = pick_layout(count, frames.frame_size(), options.get("layout_rule", "best"),
+                             max_size=options.get("max_size", 16384), power_of_two=options.get("power_of_two", False),
+                             allow_downscale=options.get("allow_downscale", True))
+    except (OSError, ValueError):
+        return None
+    if option["scale"] < 1:
+        if options.get("dedup") is not None:
+            return None  # 去重后的帧数才决定格子尺寸
+        frames = frames.resized(option["cell_size"])
+    return frames
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="智能图像拼合工具（不带参数运行时打开图形界面）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    # batch 和 watch 共用的合并参数
+    merge = argparse.ArgumentParser(add_help=False)
+    merge.add_argument("-l", "--layout", default="best",
+                       help="布局规则：best（综合评分最好）、square（行列数最接近）或固定的 行x列，如 8x8")
+    merge.add_argument("--max-size", type=int, default=16384, help="最大纹理边长，超过时缩小格子，默认 16384")
+    merge.add_argument("--pot", action="store_true", help="输出 2 的幂尺寸的纹理（不足部分补透明）")
+    merge.add_argument("--no-downscale", action="store_true", help="超过最大纹理尺寸时报错而不是缩小格子")
+    merge.add_argument("--cache", help="增量构建缓存目录：只重新处理变化的帧，没有变化时跳过")
+    merge.add_argument("--cache-size", type=float, default=4, help="缓存大小上限（GB），默认 4")
+    merge.add_argument("--pages", action="store_true",
+                       help="超过最大纹理尺寸时分成多页图集（各页并行编码，附带帧清单）而不是缩小格子")
+    merge.add_argument("--mips", type=int, nargs="?", const=0, default=None, metavar="N",
+                       help="生成逐格 mip 链（只用于 dds/bc1/bc3），N 为总级数，省略表示完整链")
+    merge.add_argument("--gutter", type=int, default=0, help="每格四周复制边缘像素的宽度，避免过滤和 mip 时渗色")
+    merge.add_argument("--dedup", type=int, nargs="?", const=0, default=None, metavar="N",
+                       help="重复帧只放一次并输出帧映射表；N 为感知哈希的汉明距离阈值，省略时只合并完全相同的帧")
+    merge.add_argument("--frames", dest="resample", metavar="N",
+                       help="先把序列重采样到 N 帧再合并；grid 表示不超过原帧数的最大 2 的幂方阵（如 97 帧 -> 64），"
+                            "会丢掉一半以上的帧时取最大方阵（如 13 帧 -> 9）")
+    merge.add_argument("--blend", action="store_true", help="重采样时混合相邻帧（交叉淡化），默认直接抽帧")
+    merge.add_argument("--motion", action="store_true",
+                       help="同时生成同布局的运动矢量图集（文件名加 _motion），用于 UE 中的帧混合")
+    merge.add_argument("--key-color", help="抠像关键色，如 255,255,255 或 #ffffff；不指定则不抠像")
+    merge.add_argument("--tolerance", type=int, default=0, help="抠像容差（0-255），默认 0 为精确匹配")
+    merge.add_argument("--softness", type=int, default=0, help="容差外的 alpha 过渡带宽度")
+    merge.add_argument("--luma-alpha", action="store_true", help="按亮度生成 alpha（加法混合序列）")
+    merge.add_argument("--report", action="store_true",
+                       help="把分阶段统计（耗时、解码帧数、读写字节数、峰值内存）写入与图集同名的 .report.json")
+    merge.add_argument("--stream", action="store_true",
+                       help="流式输出：逐行解码并直接写入编码器，不在内存中保留整张图集")
+    merge.add_argument("--trim", action="store_true",
+                       help="裁切模式：所有帧裁到 alpha 并集包围盒，缩小格子，UV 偏移写入同名 .json")
+    merge.add_argument("-f", "--format", default="png", choices=ATLAS_FORMATS,
+                       help="输出格式：png、tga、dds（未压缩）、bc1/bc3（块压缩 DDS）或带文件头的原始 RGBA（.rgba）")
+    merge.add_argument("-p", "--profile", default="balanced", choices=list(SAVE_PROFILES),
+                       help="PNG 保存配置：fast（低压缩、多线程，迭代用）、balanced、release（最高压缩）")
+    
+    batch = sub.add_parser("batch", parents=[merge], help="无界面批量合并序列帧文件夹")
+    batch.add_argument("source", help="根目录（递归查找序列文件夹）或通配符，如 'renders/*'")
+    batch.add_argument("-o", "--output-dir", help="输出目录，默认为 <根目录>/_merged")
+    batch.add_argument("-j", "--workers", type=int, default=None, help="进程数，默认使用全部核心")
+    
+    watch = sub.add_parser("watch", parents=[merge], help="持续监视文件夹，序列写完后自动合并")
+    watch.add_argument("source", help="根目录（递归查找序列文件夹）或通配符，如 'renders/*'")
+    watch.add_argument("-o", "--output-dir", help="输出目录，默认为 <根目录>/_merged")
+    watch.add_argument("--interval", type=float, default=1.0, help="扫描间隔（秒），默认 1")
+    watch.add_argument("--settle", type=float, default=5.0, help="文件夹静默多少秒后视为写完并合并，默认 5")
+    watch.add_argument("--expect", type=int, help="预期帧数：达到该帧数且都已写完时立即合并，不再等待静默")
+    
+    pack = sub.add_parser("pack", help="把最多四个灰度序列打包到一张图集的 R/G/B/A 通道")
+    pack.add_argument("folders", nargs="+", metavar="folder",
+                      help="依次对应 R、G、B、A 通道的序列文件夹，- 表示该通道留空")
+    pack.add_argument("-o", "--output-dir", default=".", help="输出目录，默认为当前目录")
+    pack.add_argument("-n", "--name", help="输出文件名（不含布局和扩展名），默认用各文件夹名连接")
+    pack.add_argument("-s", "--source", default="L",
+                      help="每个通道取帧的哪个分量：L（亮度）、R、G、B、A，可用逗号分别指定，如 L,L,A,L；默认 L")
+    pack.add_argument("-l", "--layout", default="best", help="布局规则，同 batch")
+    pack.add_argument("--max-size", type=int, default=16384, help="最大纹理边长，默认 16384")
+    pack.add_argument("--pot", action="store_true", help="输出 2 的幂尺寸的纹理")
+    pack.add_argument("--no-downscale", action="store_true", help="超过最大纹理尺寸时报错而不是缩小格子")
+    pack.add_argument("--frames", dest="resample", metavar="N", help="先把各序列重采样到 N 帧（或 grid）")
+    pack.add_argument("-f", "--format", default="png", choices=ATLAS_FORMATS, help="输出格式，同 batch")
+    pack.add_argument("-p", "--profile", default="balanced", choices=list(SAVE_PROFILES), help="PNG 保存配置")
+    
+    bench = sub.add_parser("bench", help="用合成序列测量解码、拼合、抠像、预览和保存各阶段的耗时与峰值内存")
+    bench.add_argument("--sizes", default="256x256,512x512", help="帧尺寸列表，如 256x256,1024x1024")
+    bench.add_argument("--counts", default="16,64", help="帧数列表，如 16,64")
+    bench.add_argument("--alpha", default="0.2,0.8", help="不透明像素比例列表，如 0.2,0.8")
+    bench.add_argument("--repeat", type=int, default=3, help="每个阶段重复次数，取最快一次，默认 3")
+    bench.add_argument("-o", "--output", help="结果 JSON 文件")
+    bench.add_argument("--compare", help="之前的结果 JSON，输出各阶段耗时比值")
+    return parser
+
+def parse_color(text):
+    """解析 'r,g,b' 或 '#rrggbb' 形式的颜色"""
+    text = text.strip()
+    if text.startswith("#") and len(text) == 7:
+        return tuple(int(text[i:i + 2], 16) for i in (1, 3, 5))
+    parts = [int(p) for p in text.split(",")]
+    if len(parts) != 3 or not all(0 <= p <= 255 for p in parts):
+        raise ValueError(f"无法识别的颜色：{text}")
+    return tuple(parts)
+
+def key_options_from_args(args):
+    """把命令行抠像参数转换为 key_alpha 的参数，未启用时返回 None"""
+    if args.key_color is None and not args.luma_alpha:
+        return None
+    return {"key_color": parse_color(args.key_color) if args.key_color else None,
+            "tolerance": args.tolerance, "softness": args.softness, "luminance": args.luma_alpha}
+
+def merge_options_from_args(args):
+    """把命令行的合并参数转换为 merge_folder 的参数"""
+    return dict(layout_rule=args.layout, key=key_options_from_args(args),
+                stream=args.stream, fmt=args.format, profile=args.profile, trim=args.trim, max_size=args.max_size,
+                power_of_two=args.pot, allow_downscale=not args.no_downscale, paging=args.pages,
+                cache=args.cache, cache_bytes=int(args.cache_size * (1 << 30)),
+                gutter=args.gutter, mips=args.mips, dedup=args.dedup, resample=args.resample,
+                blend=args.blend, motion=args.motion, write_report=args.report)
+
+def run_cli(argv):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.command == "bench":
+        sizes = [tuple(int(v) for v in item.lower().split("x")) for item in args.sizes.split(",")]
+        run_benchmarks(sizes, [int(v) for v in args.counts.split(",")], [float(v) for v in args.alpha.split(",")],
+                       args.repeat, args.output, args.compare)
+        return 0
+    if args.command == "pack":
+        if len(args.folders) > 4:
+            parser.error("最多打包 4 个序列（R、G、B、A）")
+        folders = [None if f == "-" else f for f in args.folders]
+        os.makedirs(args.output_dir, exist_ok=True)
+        start = time.perf_counter()
+        try:
+            save_path, (rows, cols), count = pack_channels(
+                folders, args.output_dir, args.name, args.source.replace(",", ""), args.layout, args.max_size,
+                args.pot, not args.no_downscale, args.format, args.profile, args.resample)
         except Exception as e:
-            messagebox.showerror("保存失败", f"保存文件时出错：{str(e)}")
+            print(f"[失败] {type(e).__name__}: {e}")
+            return 1
+        print(f"[完成] {count}帧  {rows}x{cols}  {time.perf_counter() - start:.2f}s -> {save_path}")
+        return 0
+    if args.mips is not None and args.format not in MIP_FORMATS:
+        parser.error(f"--mips 只能用于 {'/'.join(MIP_FORMATS)} 格式")
+    if args.command == "batch":
+        results = batch_merge(args.source, args.output_dir, args.workers, **merge_options_from_args(args))
+        return 0 if results and all(r["ok"] for r in results) else 1
+    if args.command == "watch":
+        try:
+            watch_folders(args.source, args.output_dir, args.interval, args.settle, args.expect,
+                          **merge_options_from_args(args))
+        except KeyboardInterrupt:
+            print("已停止监视")
+    return 0
+
+def array_bands(array, band_rows=256):
+    """把 (高, 宽, 4) 数组（可以是内存映射）按行切段"""
+    for top in range(0, array.shape[0], band_rows):
+        yield np.ascontiguousarray(array[top:top + band_rows])
 
-def main():
+def image_bands(img, band_rows=256):
+    """把内存中的图像按行切段，产出与流式合并相同形式的 uint8 数组"""
+    width, height = img.size
+    for top in range(0, height, band_rows):
+        bottom = min(top + band_rows, height)
+        yield np.frombuffer(img.crop((0, top, width, bottom)).tobytes(),
+                            dtype=np.uint8).reshape(bottom - top, width, 4)
+
+# 保存配置：迭代构建用 fast 几乎不压缩，发布时用 release 压到最小
+SAVE_PROFILES = {
+    "fast": {"compress_level": 1, "png_filter": "sub", "threads": None},
+    "balanced": {"compress_level": 6, "png_filter": "adaptive", "threads": None},
+    "release": {"compress_level": 9, "png_filter": "adaptive", "threads": 1},
+}
+
+ATLAS_FORMATS = ("png", "tga", "dds", "bc1", "bc3", "rgba")
+MIP_FORMATS = ("dds", "bc1", "bc3")
+
+def atlas_extension(fmt):
+    """输出格式对应的文件扩展名：块压缩格式都写成 .dds"""
+    return "dds" if fmt in BC_FORMATS else fmt
+
+def write_atlas(save_path, bands, size, fmt="png", profile="balanced", progress=None, mips=()):
+    """把逐段产出的 RGBA 数组写入文件
+    
+    fmt：png、tga（未压缩 32 位）、dds（未压缩 BGRA8）、bc1/bc3（块压缩 DDS）或 rgba（带文件头的原始数据）；
+    profile：SAVE_PROFILES 中的名称，或直接给出 write_png 参数的字典，只影响 PNG；
+    mips：第 1 级起的各级 mip 数组（见 build_mip_chain），只有 DDS 格式可以保存。
+    """
+    if mips and fmt not in MIP_FORMATS:
+        raise ValueError(f"{fmt} 格式不能保存 mip 链")
+    if fmt == "png":
+        options = SAVE_PROFILES[profile] if isinstance(profile, str) else profile
+        write_png(save_path, bands, size, progress=progress, **options)
+    elif fmt == "tga":
+        write_tga(save_path, bands, size, progress)
+    elif fmt == "dds":
+        write_dds(save_path, bands, size, progress, mips)
+    elif fmt in BC_FORMATS:
+        write_dds_bc(save_path, bands, size, fmt, progress=progress, mips=mips)
+    elif fmt == "rgba":
+        write_raw_rgba(save_path, bands, size, progress)
+    else:
+        raise ValueError(f"不支持的输出格式：{fmt}")
+    IO_STATS.add(bytes_written=os.path.getsize(save_path))
+
+def _write_raw_bands(f, bands, height, stage, progress, convert=None):
+    """逐段写出未压缩像素，convert 可在写出前转换通道顺序"""
+    if progress:
+        progress.start(stage, height)
+    for band in bands:
+        data = np.ascontiguousarray(band if convert is None else convert(band))
+        f.write(data.data)
+        if progress:
+            progress.advance(band.shape[0], bytes_written=data.nbytes)
+
+def _rgba_to_bgra(band):
+    return band[..., [2, 1, 0, 3]]
+
+RAW_RGBA_MAGIC = b"RAWRGBA\0"
+
+def write_raw_rgba(save_path, bands, size, progress=None):
+    """原始 RGBA 文件：8 字节标识 + 宽高（小端 uint32）+ 逐行像素"""
+    with open(save_path, "wb") as f:
+        f.write(RAW_RGBA_MAGIC + struct.pack("<II", *size))
+        _write_raw_bands(f, bands, size[1], "写入 RGBA", progress)
+
+def write_tga(save_path, bands, size, progress=None):
+    """未压缩 32 位 TGA（左上角为原点，BGRA 顺序），可以流式写出"""
+    width, height = size
+    with open(save_path, "wb") as f:
+        f.write(struct.pack("<BBBHHBHHHHBB", 0, 0, 2, 0, 0, 0, 0, 0, width, height, 32, 0x28))
+        _write_raw_bands(f, bands, height, "写入 TGA", progress, _rgba_to_bgra)
+
+DDS_MAGIC = b"DDS "
+DDSD_CAPS, DDSD_HEIGHT, DDSD_WIDTH, DDSD_PITCH = 0x1, 0x2, 0x4, 0x8
+DDSD_PIXELFORMAT, DDSD_MIPMAPCOUNT, DDSD_LINEARSIZE = 0x1000, 0x20000, 0x80000
+DDPF_ALPHAPIXELS, DDPF_FOURCC, DDPF_RGB = 0x1, 0x4, 0x40
+DDSCAPS_COMPLEX, DDSCAPS_TEXTURE, DDSCAPS_MIPMAP = 0x8, 0x1000, 0x400000
+
+def _dds_header(width, height, fourcc=None, pitch_or_size=0, mip_count=1):
+    """DDS 文件头：fourcc 为 None 时是未压缩 BGRA8，否则是对应的块压缩格式"""
+    flags = DDSD_CAPS | DDSD_HEIGHT | DDSD_WIDTH | DDSD_PIXELFORMAT
+    flags |= DDSD_LINEARSIZE if fourcc else DDSD_PITCH
+    caps = DDSCAPS_TEXTURE
+    if mip_count > 1:
+        flags |= DDSD_MIPMAPCOUNT
+        caps |= DDSCAPS_COMPLEX | DDSCAPS_MIPMAP
+    if fourcc:
+        pixel_format = struct.pack("<II4sIIIII", 32, DDPF_FOURCC, fourcc, 0, 0, 0, 0, 0)
+    else:
+        pixel_format = struct.pack("<II4sIIIII", 32, DDPF_RGB | DDPF_ALPHAPIXELS, b"\0\0\0\0", 32,
+                                   0x00FF0000, 0x0000FF00, 0x000000FF, 0xFF000000)
+    header = struct.pack("<IIIIIII", 124, flags, height, width, pitch_or_size, 0, mip_count)
+    header += b"\0" * 44 + pixel_format + struct.pack("<IIIII", caps, 0, 0, 0, 0)
+    return DDS_MAGIC + header
+
+def write_dds(save_path, bands, size, progress=None, mips=()):
+    """未压缩 BGRA8 的 DDS，可以流式写出；mips 为第 1 级起的各级 mip 数组"""
+    width, height = size
+    with open(save_path, "wb") as f:
+        f.write(_dds_header(width, height, pitch_or_size=width * 4, mip_count=1 + len(mips)))
+        _write_raw_bands(f, bands, height, "写入 DDS", progress, _rgba_to_bgra)
+        for level in mips:
+            f.write(np.ascontiguousarray(_rgba_to_bgra(level)).data)
+
+# 块压缩格式：BC1 每 4x4 块 8 字节（1 位透明），BC3 每块 16 字节（插值 Alpha + BC1 颜色）
+BC_FORMATS = {"bc1": (b"DXT1", 8), "bc3": (b"DXT5", 16)}
+
+def write_dds_bc(save_path, bands, size, fmt="bc1", tile_rows=64, threads=None, progress=None, mips=()):
+    """块压缩 DDS（BC1/BC3），可以流式写出；mips 为第 1 级起的各级 mip 数组
+    
+    输入的行段被重新切成 tile_rows 行（4 的倍数）的图块，在线程池中并行编码后按顺序写出；
+    宽高不是 4 的倍数时按边缘像素补齐最后一列/一行块。
+    """
+    fourcc, block_bytes = BC_FORMATS[fmt]
+    width, height = size
+    levels = [(bands, width, height)] + [(array_bands(level), level.shape[1], level.shape[0]) for level in mips]
+    if progress:
+        progress.start(f"编码 {fmt.upper()}", sum(level_height for _, _, level_height in levels))
+    workers = threads or os.cpu_count() or 1
+    
+    def tiles(level_bands):
+        pending = None
+        for band in level_bands:
+            pending = band if pending is None else np.concatenate([pending, band])
+            usable = pending.shape[0] // tile_rows * tile_rows
+            if usable:
+                yield pending[:usable]
+                pending = pending[usable:]
+        if pending is not None and len(pending):
+            yield pending
+    
+    def encode(tile, blocks_x):
+        padded = np.pad(tile, ((0, -tile.shape[0] % 4), (0, blocks_x * 4 - tile.shape[1]), (0, 0)), mode="edge")
+        rows = padded.shape[0] // 4
+        blocks = padded.reshape(rows, 4, blocks_x, 4, 4).transpose(0, 2, 1, 3, 4).reshape(-1, 16, 4)
+        return tile.shape[0], encode_bc_blocks(blocks, fmt)
+    
+    with open(save_path, "wb") as f, concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        f.write(_dds_header(width, height, fourcc, ((width + 3) // 4) * ((height + 3) // 4) * block_bytes,
+                            mip_count=len(levels)))
+        pending = []
+        
+        def flush(limit):
+            while len(pending) > limit:
+                rows, data = pending.pop(0).result()
+                f.write(data)
+                if progress:
+                    progress.advance(rows, bytes_written=len(data))
+        
+        for level_bands, level_width, _ in levels:
+            for tile in tiles(level_bands):
+                pending.append(pool.submit(encode, tile, (level_width + 3) // 4))
+                flush(2 * workers)
+        flush(0)
+
+def mip_count(size):
+    """完整 mip 链的级数（到 1x1 为止）"""
+    return max(size).bit_length()
+
+def build_mip_chain(atlas, layout, cell_size, levels=0, band_rows=128):
+    """逐格生成 mip 链，返回第 1 级起的各级数组
+    
+    每级由上一级按 2x2 缩小，但只平均与目标像素中心落在同一格（按第 0 级坐标）的源像素，
+    格子之间互不渗色；纹理补边区域视为单独的一格。RGB 按 alpha 预乘后平均，避免透明边缘发黑。
+    levels 为包含第 0 级在内的总级数，0 表示完整 mip 链。所有格子一起向量化计算，按行分段控制内存。
+    """
+    rows, cols = layout
+    cell_width, cell_height = cell_size
+    total = mip_count(atlas.shape[1::-1])
+    total = min(levels, total) if levels else total
+    chain = []
+    prev = atlas
+    for level in range(1, total):
+        axis_y = _mip_axis(prev.shape[0], level, cell_height, rows)
+        axis_x = _mip_axis(prev.shape[1], level, cell_width, cols)
+        prev = _mip_level(prev, axis_y, axis_x, band_rows)
+        chain.append(prev)
+    return chain
+
+def _mip_axis(prev_length, level, cell, count):
+    """一个方向上的 2:1 采样表：每个目标像素的两个源像素下标和各自是否参与平均"""
+    length = max(1, prev_length // 2)
+    x = np.arange(length)
+    src0, src1 = np.minimum(2 * x, prev_length - 1), np.minimum(2 * x + 1, prev_length - 1)
+    scale = 1 << level
+    cell_of = lambda center: np.minimum(center // cell, count)
+    target = cell_of((x + 0.5) * scale)
+    use0 = cell_of((src0 + 0.5) * scale / 2) == target
+    use1 = (cell_of((src1 + 0.5) * scale / 2) == target) & (src1 != src0)
+    # 格子比上一级的像素还小时两边都不在同一格，退化为普通平均
+    neither = ~(use0 | use1)
+    use0 |= neither
+    use1 |= neither & (src1 != src0)
+    return src0, src1, use0.astype(np.uint32), use1.astype(np.uint32)
+
+def _mip_level(prev, axis_y, axis_x, band_rows=128):
+    """按采样表把上一级缩小一半：alpha 预乘平均，全透明的像素退回普通平均"""
+    src_y0, src_y1, use_y0, use_y1 = axis_y
+    src_x0, src_x1, use_x0, use_x1 = axis_x
+    out = np.empty((len(src_y0), len(src_x0), 4), dtype=np.uint8)
+    for top in range(0, len(src_y0), band_rows):
+        part = slice(top, top + band_rows)
+        total_rgb = total_premul = total_alpha = count = 0
+        for src_y, use_y in ((src_y0[part], use_y0[part]), (src_y1[part], use_y1[part])):
+            source_rows = prev[src_y]
+            for src_x, use_x in ((src_x0, use_x0), (src_x1, use_x1)):
+                pixels = source_rows[:, src_x].astype(np.uint32)
+                weight = use_y[:, None] * use_x[None, :]
+                alpha = pixels[..., 3] * weight
+                total_rgb = total_rgb + pixels[..., :3] * weight[..., None]
+                total_premul = total_premul + pixels[..., :3] * alpha[..., None]
+                total_alpha = total_alpha + alpha
+                count = count + weight
+        visible = total_alpha > 0
+        safe_alpha = np.where(visible, total_alpha, 1)[..., None]
+        rgb = np.where(visible[..., None], (total_premul + safe_alpha // 2) // safe_alpha,
+                       (total_rgb + count[..., None] // 2) // count[..., None])
+        out[part, :, :3] = rgb
+        out[part, :, 3] = (total_alpha + count // 2) // count
+    return out
+
+def encode_bc_blocks(blocks, fmt="bc1"):
+    """把 (N, 16, 4) 的 RGBA 块编码为 BC1/BC3 字节串"""
+    alpha = blocks[:, :, 3]
+    if fmt == "bc1":
+        # 含有半透明以下像素的块使用三色模式，索引 3 表示全透明
+        color = _bc1_color_blocks(blocks[:, :, :3], alpha < 128)
+        return color.tobytes()
+    out = np.empty((len(blocks), 16), dtype=np.uint8)
+    out[:, :8] = _bc3_alpha_blocks(alpha)
+    out[:, 8:] = _bc1_color_blocks(blocks[:, :, :3]).view(np.uint8).reshape(-1, 8)
+    return out.tobytes()
+
+BC1_COLOR_BLOCK = np.dtype([("c0", "<u2"), ("c1", "<u2"), ("indices", "<u4")])
+
+BC1_565_SCALE = np.array([31, 63, 31], dtype=np.float32) / 255
+
+def _rgb565(colors):
+    """float RGB（0-255）量化为 565，返回 (打包值, 还原后的 RGB)"""
+    q = np.clip(np.rint(colors * BC1_565_SCALE), 0, [31, 63, 31]).astype(np.uint16)
+    packed = (q[..., 0] << 11) | (q[..., 1] << 5) | q[..., 2]
+    return packed, _expand565(packed)
+
+def _expand565(packed):
+    r, g, b = (packed >> 11) & 31, (packed >> 5) & 63, packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=-1).astype(np.float32)
+
+def _bc1_palette(c0, c1, three_color):
+    """BC1 调色板 (N, 4, 3)：四色模式插值 1/3、2/3，三色模式插值 1/2"""
+    third0, third1 = (2 * c0 + c1) / 3, (c0 + 2 * c1) / 3
+    half = (c0 + c1) / 2
+    mode = three_color[:, None]
+    return np.stack([c0, c1, np.where(mode, half, third0), np.where(mode, 0, third1)], axis=1).astype(np.float32)
+
+# 沿端点连线的位置（四色模式 0..3、三色模式 0..2）对应的调色板索引
+BC1_FOUR_COLOR_ORDER = np.array([0, 2, 3, 1])
+BC1_THREE_COLOR_ORDER = np.array([0, 2, 1, 1])
+
+def _bc1_fit_indices(pixels, palette, three_color, transparent):
+    """把像素投影到端点连线上取最近的调色板索引，返回索引和每块误差"""
+    line = palette[:, 1] - palette[:, 0]
+    length = np.einsum("ni,ni->n", line, line).clip(1e-6)
+    t = np.einsum("nki,ni->nk", pixels - palette[:, None, 0], line) / length[:, None]
+    steps = np.where(three_color, 2, 3)[:, None]
+    position = np.clip(np.rint(t * steps), 0, steps).astype(np.intp)
+    indices = np.where(three_color[:, None], BC1_THREE_COLOR_ORDER[position], BC1_FOUR_COLOR_ORDER[position])
+    indices[transparent] = 3
+    diff = pixels - np.take_along_axis(palette, indices[..., None], 1)
+    error = np.einsum("nki,nki->nk", diff, diff)
+    return indices, np.where(transparent, 0, error).sum(1)
+
+# 各调色板索引中端点 0 所占的权重
+BC1_FOUR_COLOR_WEIGHTS = np.array([1, 0, 2 / 3, 1 / 3], dtype=np.float32)
+BC1_THREE_COLOR_WEIGHTS = np.array([1, 0, 1 / 2, 0], dtype=np.float32)
+
+def _bc1_color_blocks(pixels, transparent=None):
+    """BC1 颜色块：主成分方向取端点（range fit），再做一次最小二乘修正，取误差较小的一组"""
+    pixels = pixels.astype(np.float32)
+    count = len(pixels)
+    if transparent is None:
+        transparent = np.zeros(pixels.shape[:2], dtype=bool)
+    three_color = transparent.any(1)
+    opaque = ~transparent
+    weight = opaque.sum(1, keepdims=True).clip(1)
+    mean = (pixels * opaque[..., None]).sum(1) / weight
+    centered = (pixels - mean[:, None]) * opaque[..., None]
+    cov = np.einsum("nki,nkj->nij", centered, centered)
+    # 幂迭代求主方向，初值取包围盒对角线
+    axis = pixels.max(1) - pixels.min(1) + 1e-3
+    for _ in range(4):
+        axis = np.einsum("nij,nj->ni", cov, axis)
+        axis /= np.linalg.norm(axis, axis=1, keepdims=True).clip(1e-6)
+    proj = np.einsum("nki,ni->nk", centered, axis)
+    lo = np.where(opaque, proj, np.inf).min(1)
+    hi = np.where(opaque, proj, -np.inf).max(1)
+    lo, hi = np.where(np.isfinite(lo), lo, 0), np.where(np.isfinite(hi), hi, 0)
+    best = _bc1_candidate(pixels, transparent, three_color,
+                          mean + hi[:, None] * axis, mean + lo[:, None] * axis)
+    
+    # 最小二乘：用当前索引对应的插值权重反解两个端点
+    indices = best[2]
+    alpha = np.where(three_color[:, None], BC1_THREE_COLOR_WEIGHTS[indices], BC1_FOUR_COLOR_WEIGHTS[indices]) * opaque
+    beta = (1 - alpha) * opaque
+    aa, bb, ab = (alpha * alpha).sum(1), (beta * beta).sum(1), (alpha * beta).sum(1)
+    ax = (alpha[..., None] * pixels).sum(1)
+    bx = (beta[..., None] * pixels).sum(1)
+    det = aa * bb - ab * ab
+    solvable = np.abs(det) > 1e-6
+    safe = np.where(solvable, det, 1)[:, None]
+    c0 = np.where(solvable[:, None], (ax * bb[:, None] - bx * ab[:, None]) / safe, best[3])
+    c1 = np.where(solvable[:, None], (bx * aa[:, None] - ax * ab[:, None]) / safe, best[4])
+    refined = _bc1_candidate(pixels, transparent, three_color, c0, c1)
+    better = refined[1] < best[1]
+    
+    out = np.empty(count, dtype=BC1_COLOR_BLOCK)
+    for name, pos in (("c0", 5), ("c1", 6), ("indices", 0)):
+        out[name] = np.where(better, refined[pos], best[pos])
+    return out
+
+def _bc1_candidate(pixels, transparent, three_color, end0, end1):
+    """按给定端点量化并选索引，返回 (打包索引, 误差, 索引, 端点0, 端点1, c0, c1)"""
+    p0, e0 = _rgb565(end0)
+    p1, e1 = _rgb565(end1)
+    # 四色模式要求 c0 > c1，三色模式要求 c0 <= c1，不满足时交换端点
+    swap = np.where(three_color, p0 > p1, p0 < p1)
+    p0, p1 = np.where(swap, p1, p0), np.where(swap, p0, p1)
+    e0, e1 = np.where(swap[:, None], e1, e0), np.where(swap[:, None], e0, e1)
+    # 两端点相同的四色块会被解码为三色模式，只使用索引 0
+    degenerate = three_color | (p0 == p1)
+    indices, error = _bc1_fit_indices(pixels, _bc1_palette(e0, e1, degenerate), degenerate, transparent)
+    indices = np.where(((p0 == p1) & ~three_color)[:, None], 0, indices)
+    error = np.where((p0 == p1) & ~three_color, ((pixels - e0[:, None]) ** 2).sum((1, 2)), error)
+    packed = (indices.astype(np.uint32) << (2 * np.arange(16, dtype=np.uint32))).sum(1, dtype=np.uint32)
+    return packed, error, indices, end0, end1, p0, p1
+
+def _bc3_alpha_blocks(alpha):
+    """BC3 Alpha 块：最大/最小值为端点的八值插值模式，3 位索引"""
+    alpha = alpha.astype(np.int32)
+    a0, a1 = alpha.max(1), alpha.min(1)
+    span = np.maximum(a0 - a1, 1)[:, None]
+    # 沿 a0→a1 的位置 0..7，换成 BC3 的索引编号（0=a0，1=a1，2..7 为中间值）
+    position = ((a0[:, None] - alpha) * 7 + span // 2) // span
+    indices = np.where(position == 0, 0, np.where(position == 7, 1, position + 1)).astype(np.uint64)
+    indices[a0 == a1] = 0
+    bits = (indices << (3 * np.arange(16, dtype=np.uint64))).sum(1, dtype=np.uint64)
+    out = np.empty((len(alpha), 8), dtype=np.uint8)
+    out[:, 0], out[:, 1] = a0, a1
+    out[:, 2:] = bits.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+def _png_chunk(f, chunk_type, data):
+    f.write(struct.pack(">I", len(data)) + chunk_type + data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+PNG_FILTERS = {"none": 0, "sub": 1, "up": 2, "adaptive": None}
+
+def _png_filter_rows(rows, prev, png_filter="adaptive"):
+    """对一段扫描线做 PNG 滤波
+    
+    adaptive：五种滤波都算一遍，每行取绝对值和最小的一种（压缩率好，较慢）；
+    none/sub/up：所有行使用同一种简单滤波，几乎不花时间。
+    """
+    bpp = 4
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    filter_type = PNG_FILTERS[png_filter]
+    if filter_type is not None:
+        filtered[:, 0] = filter_type
+        if filter_type == 0:
+            filtered[:, 1:] = rows
+        elif filter_type == 1:
+            filtered[:, 1:bpp + 1] = rows[:, :bpp]
+            np.subtract(rows[:, bpp:], rows[:, :-bpp], out=filtered[:, bpp + 1:])
+        else:
+            np.subtract(rows[:1], prev, out=filtered[:1, 1:])
+            np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        return filtered
+    
+    raw = rows.astype(np.int16)
+    up = np.vstack([prev[None, :], rows[:-1]]).astype(np.int16)
+    left = np.zeros_like(raw)
+    left[:, bpp:] = raw[:, :-bpp]
+    upper_left = np.zeros_like(raw)
+    upper_left[:, bpp:] = up[:, :-bpp]
+    
+    pa = np.abs(up - upper_left)
+    pb = np.abs(left - upper_left)
+    pc = np.abs(left + up - 2 * upper_left)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upper_left))
+    candidates = np.stack([raw, raw - left, raw - up, raw - (left + up) // 2, raw - paeth]).astype(np.uint8)
+    
+    # 把字节当作有符号数求绝对值和，这是 PNG 规范推荐的启发式
+    scores = np.minimum(candidates, 256 - candidates.astype(np.int16)).sum(axis=2, dtype=np.int64)
+    best = scores.argmin(axis=0)
+    filtered[:, 0] = best
+    filtered[:, 1:] = candidates[best, np.arange(rows.shape[0])]
+    return filtered
+
+PNG_IDAT_SIZE = 1 << 16
+DEFLATE_BLOCK_SIZE = 1 << 20
+DEFLATE_WINDOW = 1 << 15
+
+def _deflate_block(data, dictionary, compress_level):
+    """并行压缩的一块：原始 deflate 流，用上一块末尾 32KB 作为字典，同步刷新到字节边界以便直接拼接"""
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15, zdict=dictionary) if dictionary \
+        else zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _parallel_deflate(chunks, compress_level, threads):
+    """多线程分块 deflate（与 pigz 相同的做法），按顺序产出一个完整的 zlib 流的各个片段
+    
+    数据按固定的 1MB 分块在线程池中压缩（zlib 压缩时会释放 GIL），同时在途的块数有上限以控制内存。
+    """
+    yield b"\x78\x9c"
+    adler = 1
+    previous_tail = b""
+    pending = []
+    buffer = bytearray()
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        def submit(data):
+            nonlocal adler, previous_tail
+            adler = zlib.adler32(data, adler)
+            pending.append(pool.submit(_deflate_block, data, previous_tail, compress_level))
+            previous_tail = data[-DEFLATE_WINDOW:]
+        
+        for chunk in chunks:
+            buffer += chunk
+            # 固定偏移切块，输出与输入按什么大小分段无关（流式和内存模式逐字节一致）
+            while len(buffer) >= DEFLATE_BLOCK_SIZE:
+                submit(bytes(buffer[:DEFLATE_BLOCK_SIZE]))
+                del buffer[:DEFLATE_BLOCK_SIZE]
+            while pending and (pending[0].done() or len(pending) > 2 * threads):
+                yield pending.pop(0).result()
+        if buffer:
+            submit(bytes(buffer))
+        for future in pending:
+            yield future.result()
+    # 最后补一个空的结束块，再写 adler32 校验
+    yield b"\x03\x00" + struct.pack(">I", adler)
+
+def write_png(save_path, bands, size, compress_level=6, png_filter="adaptive", threads=1, chunk_rows=64,
+              progress=None):
+    """流式 PNG 编码：扫描线逐段滤波、压缩并写出，不需要整张图在内存中
+    
+    png_filter 见 _png_filter_rows；threads 不为 1 时分块并行压缩（None 表示使用全部核心）。
+    IDAT 块按固定大小切分，因此输出只取决于像素和参数，与输入如何分段无关。
+    """
+    width, height = size
+    
+    def filtered_chunks():
+        prev = np.zeros(width * 4, dtype=np.uint8)
+        for band in bands:
+            band = band.reshape(band.shape[0], width * 4)
+            for top in range(0, band.shape[0], chunk_rows):
+                rows = band[top:top + chunk_rows]
+                yield _png_filter_rows(rows, prev, png_filter).tobytes()
+                prev = rows[-1].copy()
+                if progress:
+                    progress.advance(rows.shape[0])
+    
+    def compressed(chunks):
+        compressor = zlib.compressobj(compress_level)
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+    
+    if threads == 1:
+        stream = compressed(filtered_chunks())
+    else:
+        stream = _parallel_deflate(filtered_chunks(), compress_level, threads or os.cpu_count())
+    
+    pending = bytearray()
+    if progress:
+        progress.start("编码 PNG", height)
+    with open(save_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        for data in stream:
+            pending += data
+            written = 0
+            while len(pending) >= PNG_IDAT_SIZE:
+                _png_chunk(f, b"IDAT", bytes(pending[:PNG_IDAT_SIZE]))
+                del pending[:PNG_IDAT_SIZE]
+                written += PNG_IDAT_SIZE
+            if progress and written:
+                progress.advance(0, bytes_written=written)
+        for start in range(0, len(pending), PNG_IDAT_SIZE):
+            _png_chunk(f, b"IDAT", bytes(pending[start:start + PNG_IDAT_SIZE]))
+        _png_chunk(f, b"IEND", b"")
+    if progress:
+        progress.bytes_written += len(pending)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run_cli(argv)
+    
     root = tk.Tk()
     root.title("智能图像拼合工具")
     root.geometry("400x200")
@@ -289,30 +3101,80 @@ def main():
              width=20).pack(pady=10)
     
     root.mainloop()
-def apply_white_transparent(new_image, width, height, rows, cols, num_images, first_image, folder_path, image_files, root):
-    """应用白转透明并刷新预览"""
-    try:
-        processed_image = white_to_transparent(new_image)
-        root.destroy()  # 关闭当前预览窗口
-        preview_image(processed_image, width, height, rows, cols, num_images, first_image, folder_path, image_files)
-    except Exception as e:
-        messagebox.showerror("处理错误", f"白转透明处理失败：{str(e)}")
-
-def white_to_transparent(img):
+def white_to_transparent(img, progress=None):
     """将纯白色(255,255,255)转换为完全透明"""
-    img = img.convert("RGBA")
-    datas = img.getdata()
-    
-    new_data = []
-    for item in datas:
-        # 当RGB值均为255时（纯白色），设置alpha通道为0
-        if item[0] == 255 and item[1] == 255 and item[2] == 255:
-            new_data.append((255, 255, 255, 0))
-        else:
-            new_data.append(item)
+    return key_alpha(img, progress=progress, **WHITE_KEY)
+
+def key_alpha(img, key_color=(255, 255, 255), tolerance=0, softness=0, luminance=False, band_rows=256,
+              progress=None):
+    """向量化抠像，返回新图像（不修改原图）
+    
+    key_color：关键色，None 表示不按颜色抠像；tolerance：RGB 各通道与关键色的最大差值不超过该值时完全透明；
+    softness：tolerance 之外的过渡带宽度，alpha 在其中线性渐变；
+    luminance：按亮度生成 alpha（亮度越低越透明），适合加法混合的序列帧。
+    按行分段拷贝并就地处理，临时数组只占一段的内存；各段在线程池中并行（numpy 运算会释放 GIL）。
+    """
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    width, height = img.size
+    out = np.empty((height, width, 4), dtype=np.uint8)
+    if progress:
+        progress.start("抠像", height)
+    
+    def process(top):
+        if progress:
+            progress.check()
+        bottom = min(top + band_rows, height)
+        band = out[top:bottom]
+        band[...] = np.frombuffer(img.crop((0, top, width, bottom)).tobytes(), dtype=np.uint8).reshape(band.shape)
+        _key_band(band, key_color, tolerance, softness, luminance)
+        if progress:
+            progress.advance(bottom - top)
     
-    img.putdata(new_data)
-    return img
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        list(pool.map(process, range(0, height, band_rows)))
+    return Image.fromarray(out, "RGBA")
+
+def _key_band(band, key_color, tolerance, softness, luminance):
+    """对一段 (行, 列, 4) 的 RGBA 数组就地抠像"""
+    alpha = band[..., 3]
+    if luminance:
+        # BT.601 亮度的 8 位定点近似，先转成 uint16 再运算（NumPy 1 中 uint8 乘标量仍是 uint8，会溢出）
+        rgb = band[..., :3].astype(np.uint16)
+        luma = rgb[..., 0] * 77 + rgb[..., 1] * 150 + rgb[..., 2] * 29
+        luma += 128
+        luma >>= 8
+        luma *= alpha
+        luma += 127
+        luma //= 255
+        alpha[...] = luma
+    if key_color is None:
+        return
+    if tolerance == 0 and softness == 0:
+        # 零容差：只有与关键色完全相同的像素变透明，与逐像素判断的结果一致
+        # 把 RGBA 当作 uint32 比较，关键色和 RGB 掩码按同样方式转换（与字节序无关）
+        key_u32 = np.array(tuple(key_color) + (0,), dtype=np.uint8).view(np.uint32)[0]
+        rgb_u32 = np.array((255, 255, 255, 0), dtype=np.uint8).view(np.uint32)[0]
+        pixels = band.view(np.uint32)[..., 0]
+        np.bitwise_and(pixels, rgb_u32, out=pixels, where=(pixels & rgb_u32) == key_u32)
+        return
+    # 各通道与关键色的差值用查表求得，取三通道最大值
+    diff = None
+    for channel in range(3):
+        lut = np.abs(np.arange(256) - key_color[channel]).astype(np.uint8)
+        channel_diff = lut[band[..., channel]]
+        diff = channel_diff if diff is None else np.maximum(diff, channel_diff, out=diff)
+    if softness > 0:
+        # 差值 -> 0~255 的不透明系数，同样查表，随后按 uint16 定点相乘
+        ramp = np.clip(np.arange(256) - tolerance, 0, softness) * 255 / softness
+        factor = np.rint(ramp).astype(np.uint16)[diff]
+        factor *= alpha
+        factor += 127
+        factor //= 255
+        alpha[...] = factor
+    else:
+        alpha[diff <= tolerance] = 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    multiprocessing.freeze_support()  # 打包成 exe 后进程池需要
+    sys.exit(main())
\ No newline at end of file